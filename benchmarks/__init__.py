@@ -0,0 +1,2 @@
+# Benchmarks of sleep_study. run.py times the hot paths on a synthetic corpus
+# written by synthetic.py, the bench_*.py scripts measure single components.
@@ -0,0 +1,122 @@
+# Compares training throughput on CPU of the per-study loop rnn.py used to
+# run (one forward and backward pass per night, gradients accumulated over
+# the batch) with bucketed, padded batches (one pass per batch), on a
+# synthetic corpus of nights of different lengths.
+#
+#   python -m benchmarks.bench_batching --n_studies 32 --batch_size 8
+
+import os
+import argparse
+import tempfile
+import numpy as np
+from time import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import sleep_study as ss
+import sleep_study.torch_data as td
+
+
+class Net(nn.Module):
+    # Same model as examples/RNN/rnn.py.
+
+    def __init__(self, n_hidden, sfreq, n_channels):
+        super().__init__()
+        self.conv = nn.Conv1d(n_channels, 3, 64, 16, 16)
+        n_out = (ss.info.INTERVAL * sfreq + 2 * 16 - 64) // 16 + 1
+        self.lstm = nn.LSTM(3 * n_out, n_hidden, batch_first=True)
+        self.fc = nn.Linear(n_hidden, len(ss.info.EVENT_DICT))
+
+    def forward(self, data):
+        n, length = data.shape[:2]
+        out = F.relu(self.conv(data.view((n * length,) + data.shape[2:])).view((n, length, -1)))
+        out, _ = self.lstm(out)
+        return F.log_softmax(self.fc(out), dim=-1)
+
+
+def make_corpus(path, n_studies, min_len, max_len, n_channels, seed):
+    rng = np.random.default_rng(seed)
+    n_samples = ss.info.INTERVAL * ss.info.REFERENCE_FREQ
+    channels = ['CH%d' % i for i in range(n_channels)]
+
+    with ss.corpus.CorpusWriter(path, channels, ss.info.REFERENCE_FREQ) as writer:
+        for i in range(n_studies):
+            n = rng.integers(min_len, max_len + 1)
+            data = rng.standard_normal((n, n_channels, n_samples), dtype=np.float32)
+            labels = rng.integers(0, len(ss.info.EVENT_DICT), n)
+            writer.add('%d_%d' % (i, i), data, labels)
+
+    return ss.corpus.Corpus(path)
+
+
+def per_study(model, optimizer, criterion, dataset, batch_size):
+    # The former loop of rnn.py: batches are lists of nights, each night is
+    # one forward and backward pass.
+    order = np.random.default_rng(0).permutation(len(dataset))
+
+    for i in range(0, len(order), batch_size):
+        optimizer.zero_grad()
+        for idx in order[i:i + batch_size]:
+            data, labels = dataset[idx]
+            data = torch.from_numpy(np.asarray(data)).float()[np.newaxis]
+            labels = torch.from_numpy(np.asarray(labels)).long()
+            output = model(data)[0]
+            loss = criterion(output, labels) / batch_size
+            loss.backward()
+        optimizer.step()
+
+
+def bucketed(model, optimizer, criterion, dataset, batch_size):
+    sampler = td.BucketBatchSampler(dataset.lengths, batch_size)
+    loader = td.make_loader(dataset, batch_sampler=sampler, collate_fn=td.pad_collate,
+                            num_workers=0, pin_memory=False)
+
+    for data, labels, _ in loader:
+        optimizer.zero_grad()
+        output = model(data)
+        loss = criterion(output.reshape((-1, output.shape[-1])), labels.reshape(-1))
+        loss.backward()
+        optimizer.step()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_studies',  default=32,     type=int,   help='Number of nights')
+    parser.add_argument('--min_len',    default=100,    type=int,   help='Min number of epochs per night')
+    parser.add_argument('--max_len',    default=400,    type=int,   help='Max number of epochs per night')
+    parser.add_argument('--n_channels', default=7,      type=int,   help='Number of channels')
+    parser.add_argument('--batch_size', default=8,      type=int,   help='Nights per batch')
+    parser.add_argument('--threads',    default=None,   type=int,   help='Number of torch threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = make_corpus(os.path.join(tmp, 'corpus'), args.n_studies, args.min_len, args.max_len, args.n_channels, 0)
+        dataset = td.NightDataset(corpus)
+        n_epochs = int(dataset.lengths.sum())
+
+        sampler = td.BucketBatchSampler(dataset.lengths, args.batch_size)
+        padded = sum(len(b) * dataset.lengths[b].max() for b in sampler._batches())
+        print('%d epochs, %d padded epochs in bucketed batches' % (n_epochs, padded - n_epochs))
+
+        print('method       epochs/s')
+
+        for name, run in [('per study', per_study), ('bucketed', bucketed)]:
+            torch.manual_seed(0)
+            model = Net(128, corpus.sfreq, args.n_channels)
+            optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+            criterion = nn.NLLLoss(ignore_index=td.PAD_LABEL)
+
+            start = time()
+            run(model, optimizer, criterion, dataset, args.batch_size)
+            print('%-10s  %9.1f' % (name, n_epochs / (time() - start)))
+
+        del dataset, corpus
+
+
+if __name__ == '__main__':
+    main()
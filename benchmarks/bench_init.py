@@ -0,0 +1,54 @@
+# Measures the time to import sleep_study and to run ss.init(), cold (empty
+# cache directory) and warm, each in a fresh interpreter like a pool worker
+# would be. Exits with status 1 when a time is over its budget.
+#
+#   python benchmarks/bench_init.py --data_dir /ux0/data/NCH_Sleep_Data
+
+import sys
+import argparse
+import tempfile
+import subprocess
+
+
+CODE = '''
+import time
+start = time.time()
+import sleep_study as ss
+end = time.time()
+ss.init(%r, %r)
+print(end - start, time.time() - end)
+'''
+
+
+def run(data_dir, cache_dir):
+    out = subprocess.run([sys.executable, '-W', 'ignore', '-c', CODE % (data_dir, cache_dir)],
+                         check=True, capture_output=True, text=True).stdout
+    return [float(x) for x in out.split()[-2:]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir',       required=True,  type=str,                   help='NCH data directory'                 )
+    parser.add_argument('--repeat',         default=5,      type=int,                   help='Number of warm runs'                )
+    parser.add_argument('--import_budget',  default=0.5,    type=float,                 help='Seconds allowed for the import'     )
+    parser.add_argument('--init_budget',    default=0.5,    type=float,                 help='Seconds allowed for a warm init()'  )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        import_time, cold_init_time = run(args.data_dir, cache_dir)
+        warm = [run(args.data_dir, cache_dir) for _ in range(args.repeat)]
+
+    import_time = min([import_time] + [x[0] for x in warm])
+    init_time = min(x[1] for x in warm)
+
+    print('import       %6.3f s (budget %.3f s)' % (import_time, args.import_budget))
+    print('init, cold   %6.3f s' % cold_init_time)
+    print('init, warm   %6.3f s (budget %.3f s)' % (init_time, args.init_budget))
+
+    if import_time > args.import_budget or init_time > args.init_budget:
+        print('Over budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
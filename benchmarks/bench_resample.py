@@ -0,0 +1,50 @@
+# Compares throughput and peak memory of the resampling methods on synthetic
+# epochs at the sampling rates found in the NCH data.
+#
+#   python -m benchmarks.bench_resample --n_epochs 1000 --n_channels 7
+
+import argparse
+import tracemalloc
+import numpy as np
+from time import time
+
+import sleep_study as ss
+
+
+def run(data, freq, method, repeat):
+    # Once untimed, so the scipy import and the filter design are not counted.
+    ss.resample.resample_epochs(data[:1], freq, ss.info.REFERENCE_FREQ, method)
+
+    tracemalloc.start()
+    start = time()
+    for _ in range(repeat):
+        out = ss.resample.resample_epochs(data, freq, ss.info.REFERENCE_FREQ, method)
+    seconds = (time() - start) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_epochs',   default=1000,   type=int,   help='Number of 30 s epochs')
+    parser.add_argument('--n_channels', default=7,      type=int,   help='Number of channels')
+    parser.add_argument('--repeat',     default=3,      type=int,   help='Number of runs per method')
+    parser.add_argument('--dtype',      default='float64', type=str, choices=['float32', 'float64'], help='Sample dtype')
+    args = parser.parse_args()
+
+    print('freq  method    epochs/s    peak memory (MB)')
+
+    for freq in [256, 400, 512]:
+        data = np.random.randn(args.n_epochs, args.n_channels, ss.info.INTERVAL * freq).astype(args.dtype)
+
+        for method in ss.resample.METHODS:
+            if method == 'decimate' and freq % ss.info.REFERENCE_FREQ != 0:
+                continue
+
+            seconds, peak, _ = run(data, freq, method, args.repeat)
+            print('%4d  %-8s  %9.1f  %9.1f' % (freq, method, args.n_epochs / seconds, peak / 1024**2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# Times the hot paths of sleep_study, per stage and per study, on a corpus
+# (by default a synthetic one, see benchmarks/synthetic.py) and writes the
+# results as JSON. With --compare, stages slower than in an earlier result
+# file by more than --tolerance make it exit with status 1.
+#
+#   python -m benchmarks.run --output before.json
+#   python -m benchmarks.run --output after.json --compare before.json
+#
+# Synthetic nights are 7 to 10 hours like the NCH ones, --max_hours 1 gives a
+# quick run.
+#
+# Seconds are the fastest of --repeat runs, peak memory is the peak of the
+# allocations traced by tracemalloc (numpy arrays included) in one more run.
+
+import io
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import subprocess
+import tracemalloc
+import numpy as np
+from time import time
+from contextlib import redirect_stdout
+
+import sleep_study as ss
+
+from . import synthetic
+
+
+def _epochs(name):
+    # Epochs at the rate of the study, and that rate.
+    data, _ = ss.data.get_sleep_eeg_and_stages(name, cache=False, downsample=False)
+    return data, data.shape[-1] // ss.info.INTERVAL
+
+
+# Per study stages: name, setup (untimed, its result is passed on) and run.
+STUDY_STAGES = [
+        ('load_study', None, lambda name, _: ss.data.load_study(name, preload=True)),
+        ('load_study_channels', None, lambda name, _: ss.data.load_study(
+            name, preload=True, channels=ss.montage.plan_matrix(ss.montage.get_plan(name, ss.info.EEG_CH_NAMES))[0])),
+        ('get_sleep_eeg_and_stages', None, lambda name, _: ss.data.get_sleep_eeg_and_stages(name, cache=False)),
+        ('downsample', _epochs, lambda name, x: ss.data.downsample_epochs(*x)),
+        ('get_demo_wavelet_features', lambda name: ss.data.get_sleep_eeg_and_stages(name, cache=False),
+         lambda name, x: ss.data.get_demo_wavelet_features(x[0])),
+        ]
+
+
+# Both print their table, which is not part of the output here.
+
+def _sleep_stage_stats():
+    ss.annotations.store = None
+    with redirect_stdout(io.StringIO()):
+        ss.data.sleep_stage_stats()
+
+
+def _channel_stats():
+    ss.edf.inventory = None
+    with redirect_stdout(io.StringIO()):
+        ss.data.channel_stats(verbose=False)
+
+
+# Corpus-wide stages, run once each.
+CORPUS_STAGES = [
+        ('sleep_stage_stats', _sleep_stage_stats),
+        ('channel_stats', _channel_stats),
+        ]
+
+
+def measure(func, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time()
+        func()
+        seconds.append(time() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(seconds), peak
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    versions = {'python': platform.python_version(), 'numpy': np.__version__}
+    for module in ['scipy', 'pandas', 'mne', 'pywt']:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            pass
+
+    return {'commit': commit, 'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'versions': versions}
+
+
+def run(data_dir, repeat=3, n_studies=None, stages=None):
+    # Without a cache directory, every run reads the data again.
+    ss.init(data_dir, None)
+
+    studies = sorted(ss.montage.available(ss.info.EEG_CH_NAMES))
+    if n_studies is not None:
+        studies = studies[:n_studies]
+
+    # Per-study stages would be missing from the results, and --compare
+    # would not notice.
+    if len(studies) == 0 and (stages is None or any(x[0] in stages for x in STUDY_STAGES)):
+        print('No study has all of %s, per-study stages can not run' % ', '.join(ss.info.EEG_CH_NAMES),
+              file=sys.stderr)
+        sys.exit(1)
+
+    results = []
+
+    def record(stage, name, seconds, peak, n_epochs=None):
+        results.append({'stage': stage, 'study': name, 'seconds': seconds,
+                        'peak_mb': peak / 1024**2, 'n_epochs': n_epochs})
+        print('%-26s %-12s %8.3f s %9.1f MB' % (stage, name or '', seconds, peak / 1024**2))
+
+    for name in studies:
+        n_epochs = int(ss.annotations.stage_counts([name]).sum(axis=1).iloc[0])
+
+        for stage, setup, func in STUDY_STAGES:
+            if stages is not None and stage not in stages:
+                continue
+
+            x = setup(name) if setup is not None else None
+            seconds, peak = measure(lambda: func(name, x), repeat)
+            record(stage, name, seconds, peak, n_epochs)
+
+    for stage, func in CORPUS_STAGES:
+        if stages is None or stage in stages:
+            seconds, peak = measure(func, repeat)
+            record(stage, None, seconds, peak)
+
+    return results
+
+
+def summarize(results):
+    # Total seconds, max peak memory and epochs/s of every stage.
+    summary = {}
+    for x in results:
+        s = summary.setdefault(x['stage'], {'seconds': 0., 'peak_mb': 0., 'n_epochs': 0})
+        s['seconds'] += x['seconds']
+        s['peak_mb'] = max(s['peak_mb'], x['peak_mb'])
+        s['n_epochs'] += x['n_epochs'] or 0
+
+    for s in summary.values():
+        s['epochs_per_second'] = s['n_epochs'] / s['seconds'] if s['n_epochs'] > 0 else None
+    return summary
+
+
+def compare(summary, old_summary, tolerance):
+    # Stages slower or larger than before by more than tolerance, relative.
+    regressions = []
+    print('stage                       seconds (old)      peak MB (old)')
+    for stage, s in summary.items():
+        if stage not in old_summary:
+            continue
+        old = old_summary[stage]
+        print('%-26s %8.3f (%8.3f) %9.1f (%9.1f)' % (stage, s['seconds'], old['seconds'], s['peak_mb'], old['peak_mb']))
+
+        for key in ['seconds', 'peak_mb']:
+            if s[key] > old[key] * (1 + tolerance):
+                regressions.append((stage, key, old[key], s[key]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir',   default=None,   type=str,   help='Corpus to run on, synthetic if not given'   )
+    parser.add_argument('--n_studies',  default=4,      type=int,   help='Studies of the synthetic corpus / to run on')
+    parser.add_argument('--min_hours',  default=7.,     type=float, help='Shortest synthetic night'                   )
+    parser.add_argument('--max_hours',  default=10.,    type=float, help='Longest synthetic night'                    )
+    parser.add_argument('--seed',       default=0,      type=int,   help='Seed of the synthetic corpus'               )
+    parser.add_argument('--repeat',     default=3,      type=int,   help='Number of timed runs'                       )
+    parser.add_argument('--stages',     default=None,   type=str,   nargs='+', help='Stages to run, all by default'   )
+    parser.add_argument('--output',     default=None,   type=str,   help='JSON file to write the results to'          )
+    parser.add_argument('--compare',    default=None,   type=str,   help='JSON results to compare against'            )
+    parser.add_argument('--tolerance',  default=0.2,    type=float, help='Allowed relative slowdown'                  )
+    args = parser.parse_args()
+
+    tmp_dir = None
+    data_dir = args.data_dir
+    if data_dir is None:
+        tmp_dir = tempfile.mkdtemp()
+        data_dir = synthetic.write_corpus(tmp_dir, args.n_studies, args.min_hours, args.max_hours, args.seed, verbose=False)
+
+    try:
+        results = run(data_dir, args.repeat, args.n_studies, args.stages)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    summary = summarize(results)
+    output = {
+            'environment': environment(),
+            'config': vars(args),
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'summary': summary,
+            'results': results,
+            }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+
+        regressions = compare(summary, old['summary'], args.tolerance)
+        for stage, key, before, after in regressions:
+            print('Regression in %s: %s %.3f -> %.3f' % (stage, key, before, after))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# Writes a synthetic corpus with the layout of the NCH data, so benchmarks
+# run without access to it:
+#
+#   Sleep_Data/<patient>_<study>.edf   16 bit EDF, 1 s records
+#   Sleep_Data/<patient>_<study>.tsv   onset, duration, description
+#   Health_Data/SLEEP_STUDY.csv
+#   Health_Data/DEMOGRAPHIC.csv
+#
+# Studies are recorded at 256, 400 or 512 Hz, some with a few EEG channels
+# missing, under alias names or as other derivations, and respiratory
+# channels at lower rates. Annotations follow a sleep stage Markov chain with
+# apneas, hypopneas, desaturations and arousals.
+#
+#   python -m benchmarks.synthetic /tmp/nch_synthetic --n_studies 8
+
+import os
+import argparse
+import numpy as np
+from datetime import datetime, timedelta
+
+import sleep_study as ss
+
+SFREQS = [256, 400, 512]
+
+# Channel and its sampling rate relative to the study's rate.
+EEG_CHANNELS = [(x, 1.) for x in ss.info.EEG_CH_NAMES]
+OTHER_CHANNELS = [
+        ('ECG EKG2-EKG', 1.),
+        ('EOG LOC-M2', 1.),
+        ('EOG ROC-M1', 1.),
+        ('EMG Chin1-Chin2', 1.),
+        ('EMG LLeg-RLeg', 1.),
+        ('Resp Airflow', 1 / 4),
+        ('Resp PTAF', 1 / 4),
+        ('Resp Thoracic', 1 / 4),
+        ('Resp Abdominal', 1 / 4),
+        ('SpO2', 1 / 16),
+        ('Snore', 1.),
+        ('Capno', 1 / 4),
+        ]
+
+# Sleep stage transition probabilities, rows and columns in EVENT_DICT order.
+STAGES = list(ss.info.EVENT_DICT.keys())
+TRANSITIONS = np.array([
+        [0.90, 0.08, 0.01, 0.00, 0.01],
+        [0.06, 0.70, 0.22, 0.00, 0.02],
+        [0.02, 0.02, 0.88, 0.06, 0.02],
+        [0.01, 0.00, 0.06, 0.93, 0.00],
+        [0.03, 0.02, 0.03, 0.00, 0.92],
+        ])
+
+# Events per hour of sleep, and their duration range in seconds.
+EVENTS = [
+        ('Obstructive Apnea', 2., (10, 30)),
+        ('Central Apnea', 0.5, (10, 20)),
+        ('Mixed Apnea', 0.2, (10, 25)),
+        ('Obstructive Hypopnea', 3., (10, 40)),
+        ('Hypopnea', 1., (10, 30)),
+        ('Oxygen Desaturation', 4., (5, 30)),
+        ('EEG arousal', 8., (3, 15)),
+        ]
+
+
+def _field(value, width):
+    return str(value).ljust(width)[:width].encode('latin-1')
+
+
+def write_edf(path, channels, n_records, start, rng, chunk=600):
+    # channels is a list of (label, samples per 1 s record).
+    n = len(channels)
+    labels = [x for x, _ in channels]
+    n_samples = [int(x) for _, x in channels]
+
+    header = b''.join([
+            _field('0', 8),
+            _field('X X X X', 80),
+            _field('Startdate %s X X X' % start.strftime('%d-%b-%Y').upper(), 80),
+            _field(start.strftime('%d.%m.%y'), 8),
+            _field(start.strftime('%H.%M.%S'), 8),
+            _field(256 + 256 * n, 8),
+            _field('', 44),
+            _field(n_records, 8),
+            _field(1, 8),
+            _field(n, 4),
+            ])
+
+    for values, width in [(labels, 16), ([''] * n, 80), (['uV'] * n, 8),
+                          ([-3200] * n, 8), ([3200] * n, 8), ([-32768] * n, 8), ([32767] * n, 8),
+                          ([''] * n, 80), (n_samples, 8), ([''] * n, 32)]:
+        header += b''.join(_field(x, width) for x in values)
+
+    with open(path, 'wb') as f:
+        f.write(header)
+
+        # Records hold every channel one after the other, written chunk
+        # records at a time so memory does not grow with the night.
+        for i in range(0, n_records, chunk):
+            m = min(chunk, n_records - i)
+            record = np.concatenate([(rng.standard_normal((m, k), dtype=np.float32) * 400).astype('<i2')
+                                     for k in n_samples], axis=1)
+            f.write(record.tobytes())
+
+
+def sleep_stages(n_epochs, rng):
+    # Codes into STAGES, starting awake.
+    u = rng.random(n_epochs)
+    cum = np.cumsum(TRANSITIONS, axis=1)
+    stages = np.empty(n_epochs, dtype=np.int64)
+    s = 0
+    for i in range(n_epochs):
+        stages[i] = s
+        s = min(np.searchsorted(cum[s], u[i]), len(STAGES) - 1)
+    return stages
+
+
+def write_tsv(path, n_epochs, offset, rng):
+    stages = sleep_stages(n_epochs, rng)
+    onsets = offset + ss.info.INTERVAL * np.arange(n_epochs)
+
+    rows = [(0., 0., 'Lights Off')]
+    rows += [(onsets[i], float(ss.info.INTERVAL), STAGES[stages[i]]) for i in range(n_epochs)]
+
+    sleep_hours = (stages != 0).sum() * ss.info.INTERVAL / 3600
+    asleep = onsets[stages != 0]
+    for description, rate, (low, high) in EVENTS:
+        n = rng.poisson(rate * sleep_hours)
+        if n == 0 or len(asleep) == 0:
+            continue
+        at = rng.choice(asleep, n) + rng.uniform(0, ss.info.INTERVAL, n)
+        rows += [(x, float(d), description) for x, d in zip(at, rng.uniform(low, high, n).round(1))]
+
+    rows += [(onsets[-1] + ss.info.INTERVAL, 0., 'Lights On')]
+    rows.sort(key=lambda x: x[0])
+
+    with open(path, 'w') as f:
+        f.write('onset\tduration\tdescription\n')
+        f.writelines('%.3f\t%.1f\t%s\n' % x for x in rows)
+
+
+def study_channels(sfreq, rng):
+    # Drops an EEG channel from some studies, renames M1/M2 to A1/A2 or
+    # records the reversed derivation in others.
+    channels = []
+    for label, rate in EEG_CHANNELS:
+        r = rng.random()
+        if r < 0.03:
+            continue
+        elif r < 0.13:
+            label = label.replace('M1', 'A1').replace('M2', 'A2')
+        elif r < 0.18:
+            kind, derivation = label.split()
+            label = kind + ' ' + '-'.join(derivation.split('-')[::-1])
+        channels.append((label, rate))
+
+    channels.append(('EEG M1-M2', 1.))
+    channels += OTHER_CHANNELS
+
+    return [(label, max(int(sfreq * rate), 1)) for label, rate in channels]
+
+
+def write_corpus(root, n_studies=8, min_hours=7., max_hours=10., seed=0, verbose=True):
+    rng = np.random.default_rng(seed)
+    root = os.path.abspath(os.path.expanduser(root))
+    os.makedirs(os.path.join(root, 'Sleep_Data'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'Health_Data'), exist_ok=True)
+
+    sleep_study = []
+    demographic = []
+
+    for i in range(n_studies):
+        patient_id, study_id = 10000 + i, 20000 + i
+        name = '%d_%d' % (patient_id, study_id)
+
+        if verbose:
+            print('Writing %s, %d of %d' % (name, i + 1, n_studies))
+
+        sfreq = SFREQS[rng.integers(len(SFREQS))]
+        n_epochs = int(rng.uniform(min_hours, max_hours) * 3600 / ss.info.INTERVAL)
+        offset = float(rng.integers(60, 600))
+        n_records = int(offset + n_epochs * ss.info.INTERVAL) + 1 + int(rng.integers(0, 30))
+        start = datetime(2015, 1, 1, 20, 0, 0) + timedelta(days=int(i), minutes=int(rng.integers(0, 180)))
+
+        write_edf(os.path.join(root, 'Sleep_Data', name + '.edf'), study_channels(sfreq, rng), n_records, start, rng)
+        write_tsv(os.path.join(root, 'Sleep_Data', name + '.tsv'), n_epochs, offset, rng)
+
+        age = int(rng.integers(365, 18 * 365))
+        sleep_study.append('%d,%d,%s,%d' % (patient_id, study_id, start.strftime('%m/%d/%Y %I:%M:%S %p'), age))
+        demographic.append('%d,%s,%s,%s,%s,%s' % (
+            patient_id, (start - timedelta(days=age)).strftime('%Y-%m-%d'),
+            *[['F', 'Female'], ['M', 'Male']][i % 2], ['White', 'Black', 'Asian'][i % 3], 'Not Hispanic'))
+
+    with open(os.path.join(root, 'Health_Data', ss.info.SLEEP_STUDY_NAME), 'w') as f:
+        f.write('STUDY_PAT_ID,SLEEP_STUDY_ID,SLEEP_STUDY_START_DATETIME,AGE_AT_SLEEP_STUDY_DAYS\n')
+        f.write('\n'.join(sleep_study) + '\n')
+
+    with open(os.path.join(root, 'Health_Data', ss.info.DEMOGRAPHIC), 'w') as f:
+        f.write('STUDY_PAT_ID,BIRTH_DATE,PCORI_GENDER_CD,GENDER_DESCR,RACE_DESCR,ETHNICITY_DESCR\n')
+        f.write('\n'.join(demographic) + '\n')
+
+    return root
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root',                         type=str,   help='Output directory')
+    parser.add_argument('--n_studies',  default=8,      type=int,   help='Number of studies')
+    parser.add_argument('--min_hours',  default=7.,     type=float, help='Shortest night')
+    parser.add_argument('--max_hours',  default=10.,    type=float, help='Longest night')
+    parser.add_argument('--seed',       default=0,      type=int,   help='Random seed')
+    args = parser.parse_args()
+
+    write_corpus(args.root, args.n_studies, args.min_hours, args.max_hours, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.distributed as dist
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
 import glog as log
 
 import sleep_study as ss
+import sleep_study.torch_data as td
 
 torch.manual_seed(1)
 
@@ -22,30 +22,6 @@ def my_log(*a, **kw):
         log.debug(*a, **kw)
 
 
-class EEG_dataset(Dataset):
-
-    def __init__(self, root_dir, gpu=False, transform=None):
-
-        root_dir = os.path.expanduser(root_dir)
-        root_dir = os.path.abspath(root_dir)
-
-        self.root_dir = root_dir
-        self.file_list = os.listdir(self.root_dir)
-
-        self.transform = transform
-
-    def __len__(self):
-        return len(self.file_list)
-
-    def __getitem__(self, idx):
-
-        path = self.root_dir + '/' + self.file_list[idx]
-        tmp = np.load(path)
-        data, labels = torch.from_numpy(tmp['data']).float(), torch.from_numpy(tmp['labels']).long()
-        log.debug(str(data.shape) + ', ' + str(labels.shape) + ', ' + str(idx) + ', ' + path)
-        return data, labels
-
-
 class Net(nn.Module):
 
     def __init__(self, n_hidden, sfreq, n_channels):
@@ -53,38 +29,44 @@ class Net(nn.Module):
         super().__init__()
 
         self.conv = nn.Conv1d(n_channels, 3, 64, 16, 16)
-        self.lstm = nn.LSTM(1437, n_hidden)
+        n_out = (ss.info.INTERVAL * sfreq + 2 * 16 - 64) // 16 + 1
+        self.lstm = nn.LSTM(3 * n_out, n_hidden, batch_first=True)
         self.fc = nn.Linear(n_hidden, len(ss.info.EVENT_DICT))
 
     def forward(self, data):
 
-        out = self.conv(data)
-        out = out.view((len(out), 1, -1))
+        # data is (batch) by (max length) by (num channels) by (num samples),
+        # padded after the end of each night, see td.pad_collate.
+        n, length = data.shape[:2]
+
+        out = self.conv(data.view((n * length,) + data.shape[2:]))
+        out = out.view((n, length, -1))
         out = F.relu(out)
 
+        # The LSTM runs forward in time, so the padding after the end of a
+        # night does not change the outputs of its epochs, and the loss
+        # ignores the padded ones. Packing the batch gives the same result but
+        # takes a much slower path on CPU.
         out, _ = self.lstm(out)
-        out = out.view((len(out), -1))
 
         out = self.fc(out)
-        out = F.log_softmax(out, dim=1)
+        out = F.log_softmax(out, dim=-1)
 
         return out
 
 
 def predict(output, labels):
-    pred = output.argmax(axis=1)
-    return pred.eq(labels.data.view_as(pred)).cpu().tolist()
-
-def my_collate(batch):
-    data = [item[0] for item in batch]
-    target = [item[1] for item in batch]
-    return [data, target]
+    mask = labels != td.PAD_LABEL
+    pred = output.argmax(axis=-1)
+    return pred[mask].eq(labels[mask]).cpu().tolist()
 
 
 parser = argparse.ArgumentParser()
 # Training args
 parser.add_argument('--epochs',                 default=1,          type=int,                                       help='Number of epochs'                       )
 parser.add_argument('--batch_size',             default=1,          type=int,                                       help='Batch size per worker'                  )
+parser.add_argument('--max_len',                default=None,       type=int,                                       help='Max number of epochs per sequence'      )
+parser.add_argument('--normalize',              default=None,       type=str,   choices=['study', 'corpus'],        help='Standardize channels per study/corpus'  )
 parser.add_argument('--lr',                     default=1e-3,       type=float,                                     help='Learning rate'                          )
 parser.add_argument('--momentum',               default=0.9,        type=float,                                     help='Momentum'                               )
 parser.add_argument('--weight_decay',           default=0,          type=float,                                     help='Weight decay'                           )
@@ -126,10 +108,13 @@ if args.deterministic:
 dist.init_process_group(backend=args.backend)
 
 
-n_channels = 6
-criterion = nn.NLLLoss()
+criterion = nn.NLLLoss(ignore_index=td.PAD_LABEL)
 
-model = Net(128, 256, n_channels)
+# Whole nights (or pieces of max_len epochs), batched with nights of similar length.
+dataset = td.NightDataset('~/preprocessed/corpus', max_len=args.max_len, normalize=args.normalize)
+n_channels = len(dataset.corpus.channels)
+
+model = Net(128, dataset.corpus.sfreq, n_channels)
 
 if not args.cpu:
     model = model.cuda()
@@ -142,46 +127,38 @@ else:
 
 optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum)
 
-dataset = EEG_dataset('~/preprocessed')
-
-sampler = torch.utils.data.distributed \
-            .DistributedSampler(dataset, rank=args.rank,
+sampler = td.BucketBatchSampler(dataset.lengths, args.batch_size,
                                 num_replicas=args.world_size,
-                                shuffle=True)
+                                rank=args.rank)
 
-loader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler, 
-                    collate_fn=my_collate, num_workers=args.num_workers)
-                    # shuffle=True, pin_memory=True, num_workers=args.num_workers)
+loader = td.make_loader(dataset, batch_sampler=sampler, collate_fn=td.pad_collate,
+                        num_workers=args.num_workers, pin_memory=not args.cpu)
 
 
 for epoch in range(args.epochs):
     running_acc = []
     running_loss = []
 
-    for i, (data_batch, labels_batch) in enumerate(loader):
+    sampler.set_epoch(epoch)
 
-        loss_batch = 0
-        pred = []
+    for i, (data, labels, _) in enumerate(loader):
 
-        for data, labels in zip(data_batch, labels_batch):
+        if not args.cpu:
+            data = data.cuda(non_blocking=True)
+            labels = labels.cuda(non_blocking=True)
 
-            if not args.cpu:
-                data = data.cuda()
-                labels = labels.cuda()
-
-            optimizer.zero_grad()
-            output = model(data)
-
-            loss = criterion(output, labels) / args.batch_size
-            loss.backward()
-
-            loss_batch += loss
-            pred += predict(output, labels)
+        # One forward and backward pass for the whole batch.
+        optimizer.zero_grad()
+        output = model(data)
 
+        loss = criterion(output.reshape((-1, output.shape[-1])), labels.reshape(-1))
+        loss.backward()
         optimizer.step()
 
+        pred = predict(output, labels)
+
         running_acc += pred
-        running_loss.append(loss_batch.item())
+        running_loss.append(loss.item())
 
         if (i + 1) % args.disp_interval == 0:
             my_log('Rank %d, epoch %d, batch %d, running acc: %.2f, running loss: %.6f', args.rank, epoch + 1, i + 1, np.mean(running_acc), np.mean(running_loss))
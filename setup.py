@@ -22,6 +22,7 @@ REQUIRED = ['matplotlib', 'mne', 'numpy', 'pandas']
 # What packages are optional?
 EXTRAS = {
     # 'fancy feature': [],
+    'torch': ['torch'],
 }
 
 # The rest you shouldn't have to touch too much :)
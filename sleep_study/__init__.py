@@ -1,15 +1,59 @@
+import os
+
+# mne, pywt and scipy are only imported by the functions that use them, so
+# importing the package and calling init() stay cheap, e.g. in pool workers.
 from . import info
+from . import profiling
+from . import resample
+from . import epochs
+from . import annotations
+from . import respiratory
+from . import hypnogram
+from . import edf
+from . import montage
 from . import data
+from . import prefetch
+from . import features
+from . import cohort
 from . import dataset
+from . import stats
+from . import corpus
+from . import preprocessing
 
 data_dir = None
+cache_dir = None
+
+def init(tmp_dir='/ux0/data/NCH_Sleep_Data', tmp_cache_dir=None):
+    global data_dir, cache_dir
+
+    # Per-study results are cached on disk only when a cache directory is given.
+    if tmp_cache_dir is not None:
+        tmp_cache_dir = os.path.abspath(os.path.expanduser(tmp_cache_dir))
+
+    # Already initialized, e.g. in a forked worker.
+    if data.study_list is not None and (data_dir, cache_dir) == (tmp_dir, tmp_cache_dir):
+        return
 
-def init(tmp_dir='/ux0/data/NCH_Sleep_Data'):
-    global data_dir
     data_dir = tmp_dir
+    cache_dir = tmp_cache_dir
+
+    # Drop everything loaded from a previous data or cache directory.
+    annotations.store = None
+    data.cache_index = None
+    hypnogram.hypnograms = None
+    edf.inventory = None
+    montage.plans = {}
+    cohort.table = None
+    cohort.diagnoses = None
+    info._health_cache.clear()
+    info.health = info.HealthData()
+
     data.study_list = data.init_study_list()
-    age_fn = data.init_age_file()
-    print("age information stored in", age_fn)
 
     # Load the sleep study info
-    info.SLEEP_STUDY = info.load_health_info(info.SLEEP_STUDY, False)
+    info.SLEEP_STUDY = info.load_health_info(info.SLEEP_STUDY_NAME, False)
+    info.SLEEP_STUDY_DATES = info.build_sleep_study_dates(info.SLEEP_STUDY)
+
+    data.age_table = data.init_age_table()
+    if cache_dir is not None:
+        data.init_age_file()
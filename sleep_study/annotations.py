@@ -0,0 +1,249 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+
+import sleep_study as ss
+
+# All <study>.tsv annotations in one columnar table, sorted by study:
+#
+#   study.npy        int32 study code of every annotation
+#   onset.npy        float64
+#   duration.npy     float64
+#   description.npy  int32 code into the list of unique descriptions
+#   meta.json        studies, descriptions, per-study offsets and the
+#                    mtime/size of every .tsv when it was read
+#
+# The store lives in ss.cache_dir/annotations (in memory only when there is
+# no cache directory) and is refreshed incrementally: only new or changed
+# .tsv files are parsed again.
+
+COLUMNS = ['study', 'onset', 'duration', 'description']
+DTYPES = ['int32', 'float64', 'float64', 'int32']
+
+store = None # Loaded on first use by get_store().
+
+
+def tsv_path(name):
+    return os.path.join(ss.data_dir, 'Sleep_Data', name + '.tsv')
+
+
+def tsv_stamp(name):
+    st = os.stat(tsv_path(name))
+    return [st.st_mtime_ns, st.st_size]
+
+
+def read_tsv(name):
+    with ss.profiling.timer('annotations', name) as t:
+        df = pd.read_csv(tsv_path(name), sep='\t')
+        df['description'] = df.description.fillna('').astype(str)
+        t.bytes = os.path.getsize(tsv_path(name))
+    return df
+
+
+def _read_columns(name):
+    df = read_tsv(name)
+    return name, tsv_stamp(name), df.onset.values.astype(np.float64), \
+            df.duration.values.astype(np.float64), df.description.values
+
+
+class AnnotationStore:
+
+    def __init__(self, studies, descriptions, stamps, study, onset, duration, description):
+        self.studies = list(studies)
+        self.descriptions = list(descriptions)
+        self.stamps = stamps
+
+        self.study = study
+        self.onset = onset
+        self.duration = duration
+        self.description = description
+
+        self.offsets = np.searchsorted(study, np.arange(len(self.studies) + 1)).astype(np.int64)
+        self.study_ids = {name: i for i, name in enumerate(self.studies)}
+
+    def __len__(self):
+        return len(self.study)
+
+    def study_slice(self, name):
+        i = self.study_ids[name]
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def get(self, name):
+        idx = self.study_slice(name)
+        return pd.DataFrame({
+            'onset': self.onset[idx],
+            'duration': self.duration[idx],
+            'description': np.asarray(self.descriptions, dtype=object)[self.description[idx]],
+            })
+
+    def frame(self):
+        return pd.DataFrame({
+            'study': pd.Categorical.from_codes(self.study, self.studies),
+            'onset': self.onset,
+            'duration': self.duration,
+            'description': pd.Categorical.from_codes(self.description, self.descriptions),
+            })
+
+    def counts(self, studies=None):
+        # (num studies) by (num descriptions) occurrence counts.
+        res = np.bincount(self.study * len(self.descriptions) + self.description,
+                          minlength=len(self.studies) * len(self.descriptions))
+        res = pd.DataFrame(res.reshape(len(self.studies), len(self.descriptions)),
+                           index=self.studies, columns=self.descriptions)
+        if studies is not None:
+            res = res.loc[list(studies)]
+        return res
+
+    def description_codes(self, names, case=False):
+        # Codes of the descriptions in names, case-insensitive unless case is True.
+        if case:
+            names = set(names)
+            return np.array([i for i, x in enumerate(self.descriptions) if x in names], dtype=np.int64)
+
+        names = set(x.lower() for x in names)
+        return np.array([i for i, x in enumerate(self.descriptions) if x.lower() in names], dtype=np.int64)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+
+        # Replace files instead of overwriting them, other processes may
+        # have the old ones memory-mapped.
+        for column in COLUMNS:
+            tmp_path = os.path.join(path, column + '.npy.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, getattr(self, column))
+            os.replace(tmp_path, os.path.join(path, column + '.npy'))
+
+        meta = {'studies': self.studies, 'descriptions': self.descriptions, 'stamps': self.stamps}
+
+        tmp_path = os.path.join(path, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        columns = [np.load(os.path.join(path, x + '.npy'), mmap_mode=mmap_mode) for x in COLUMNS]
+        return cls(meta['studies'], meta['descriptions'], meta['stamps'], *columns)
+
+
+def store_path():
+    if ss.cache_dir is None:
+        return None
+    return os.path.join(ss.cache_dir, 'annotations')
+
+
+def build_store(studies=None, old=None, n_workers=1, verbose=True):
+    if studies is None:
+        studies = ss.data.study_list
+    studies = sorted(studies)
+
+    if old is None:
+        old = AnnotationStore([], [], {}, *[np.empty(0, dtype=x) for x in DTYPES])
+
+    stamps = {name: tsv_stamp(name) for name in studies}
+    todo = [name for name in studies if old.stamps.get(name) != stamps[name]]
+
+    if len(todo) == 0 and studies == old.studies:
+        return old
+
+    if verbose:
+        print('Reading %d of %d annotation files' % (len(todo), len(studies)))
+
+    if n_workers > 1 and len(todo) > 0:
+        with Pool(n_workers) as pool:
+            new = pool.map(_read_columns, todo, chunksize=16)
+    else:
+        new = [_read_columns(name) for name in todo]
+    new = {x[0]: x[1:] for x in new}
+
+    descriptions = list(old.descriptions)
+    description_ids = {x: i for i, x in enumerate(descriptions)}
+
+    parts = {x: [] for x in COLUMNS}
+
+    for i, name in enumerate(studies):
+        if name in new:
+            stamps[name], onset, duration, description = new[name]
+
+            codes, uniques = pd.factorize(description)
+            for x in uniques:
+                if x not in description_ids:
+                    description_ids[x] = len(descriptions)
+                    descriptions.append(x)
+
+            ids = np.array([description_ids[x] for x in uniques], dtype=np.int32)
+            description = ids[codes]
+
+        else:
+            idx = old.study_slice(name)
+            onset, duration, description = old.onset[idx], old.duration[idx], old.description[idx]
+
+        parts['study'].append(np.full(len(onset), i, dtype=np.int32))
+        parts['onset'].append(onset)
+        parts['duration'].append(duration)
+        parts['description'].append(description)
+
+    columns = [np.concatenate(parts[x] + [np.empty(0, dtype=dtype)]).astype(dtype)
+               for x, dtype in zip(COLUMNS, DTYPES)]
+    return AnnotationStore(studies, descriptions, stamps, *columns)
+
+
+def get_store(refresh=False, n_workers=1, verbose=False):
+    # The store is checked against the .tsv files once per process, or again
+    # when refresh is True.
+    global store
+
+    if store is not None and not refresh:
+        return store
+
+    path = store_path()
+    old = store
+    if old is None and path is not None and os.path.exists(os.path.join(path, 'meta.json')):
+        old = AnnotationStore.load(path)
+
+    new = build_store(ss.data.study_list, old, n_workers, verbose)
+
+    if new is old:
+        store = old
+    elif path is not None:
+        new.save(path)
+        store = AnnotationStore.load(path)
+    else:
+        store = new
+
+    return store
+
+
+def get_annotations(name):
+    # Served from the store when it is loaded and up to date, otherwise read
+    # from the .tsv file directly.
+    if store is not None and name in store.study_ids and store.stamps[name] == tsv_stamp(name):
+        return store.get(name)
+
+    return read_tsv(name)
+
+
+def stage_counts(studies=None):
+    # (num studies) by (num sleep stages) counts of the labels in
+    # info.EVENT_DICT, matched case-insensitively.
+    s = get_store()
+
+    stages = list(ss.info.EVENT_DICT)
+    lookup = np.full(len(s.descriptions) + 1, len(stages), dtype=np.int64)
+    for i, stage in enumerate(stages):
+        lookup[s.description_codes([stage])] = i
+
+    res = np.bincount(s.study * (len(stages) + 1) + lookup[s.description],
+                      minlength=len(s.studies) * (len(stages) + 1))
+    res = pd.DataFrame(res.reshape(len(s.studies), len(stages) + 1)[:, :-1],
+                       index=s.studies, columns=stages)
+
+    if studies is not None:
+        res = res.loc[list(studies)]
+    return res
@@ -0,0 +1,165 @@
+import numpy as np
+
+import sleep_study as ss
+
+# One row per study, indexed by study name, joining SLEEP_STUDY, DEMOGRAPHIC,
+# the EDF header inventory, the sleep stage counts of the annotation store
+# and the respiratory indices. Diagnoses are kept as unique (patient, code)
+# pairs next to it.
+# Predicates are vectorized masks over this table and compose with &, | and ~:
+#
+#   ss.cohort.query(ss.cohort.age_between(2, 6) & ss.cohort.sex('Female')
+#                   & ss.cohort.has_channels(ss.info.EEG_CH_NAMES))
+
+table = None # Built on first use by get_study_table().
+diagnoses = None
+
+
+def build_study_table():
+    df = ss.info.SLEEP_STUDY.copy()
+    df['STUDY'] = df.STUDY_PAT_ID.astype(str) + '_' + df.SLEEP_STUDY_ID.astype(str)
+    df = df[df.STUDY.isin(ss.data.study_list)].copy()
+    df['AGE_YEARS'] = df.AGE_AT_SLEEP_STUDY_DAYS / 365
+
+    demographic = ss.info.health.DEMOGRAPHIC
+    demographic = demographic.drop_duplicates('STUDY_PAT_ID')
+    df = df.merge(demographic, on='STUDY_PAT_ID', how='left')
+
+    inventory = ss.edf.get_inventory().studies
+    inventory = inventory.rename(columns={
+        'study': 'STUDY',
+        'n_channels': 'N_CHANNELS',
+        'sfreq': 'SFREQ',
+        'duration': 'DURATION',
+        'start': 'EDF_START',
+        })
+    df = df.merge(inventory, on='STUDY', how='left')
+
+    counts = ss.annotations.stage_counts()
+    counts.columns = ['STAGE_' + x.split()[-1] for x in counts.columns]
+    df = df.merge(counts, left_on='STUDY', right_index=True, how='left')
+
+    indices = ss.respiratory.get_indices()[['TST_HOURS', 'AHI', 'ODI', 'AROUSAL_INDEX']]
+    df = df.merge(indices, left_on='STUDY', right_index=True, how='left')
+
+    return df.set_index('STUDY', drop=False)
+
+
+def build_diagnoses(column='DX_CODE'):
+    df = ss.info.load_health_info(ss.info.DIAGNOSIS, usecols=['STUDY_PAT_ID', column])
+    return df.dropna().drop_duplicates()
+
+
+def get_study_table(refresh=False):
+    # The underlying tables are cached on disk, joining them is cheap, so the
+    # table is only kept in memory.
+    global table
+
+    if table is None or refresh:
+        table = build_study_table()
+    return table
+
+
+def get_diagnoses(refresh=False):
+    global diagnoses
+
+    if diagnoses is None or refresh:
+        diagnoses = build_diagnoses()
+    return diagnoses
+
+
+class Predicate:
+
+    def __init__(self, func):
+        # func maps the study table to a boolean mask of its rows.
+        self.func = func
+
+    def __call__(self, df):
+        return np.asarray(self.func(df), dtype=bool)
+
+    def __and__(self, other):
+        return Predicate(lambda df: self(df) & other(df))
+
+    def __or__(self, other):
+        return Predicate(lambda df: self(df) | other(df))
+
+    def __invert__(self):
+        return Predicate(lambda df: ~self(df))
+
+
+OPS = {
+        '==': lambda x, v: x == v,
+        '!=': lambda x, v: x != v,
+        '<': lambda x, v: x < v,
+        '<=': lambda x, v: x <= v,
+        '>': lambda x, v: x > v,
+        '>=': lambda x, v: x >= v,
+        'in': lambda x, v: x.isin(v),
+        }
+
+
+def where(column, op, value):
+    return Predicate(lambda df: OPS[op](df[column], value).fillna(False))
+
+
+def age_between(low, high):
+    # In years, low included and high excluded, like get_studies_by_patient_age.
+    return where('AGE_AT_SLEEP_STUDY_DAYS', '>=', low * 365) & where('AGE_AT_SLEEP_STUDY_DAYS', '<', high * 365)
+
+
+def sex(*values):
+    return where('GENDER_DESCR', 'in', values)
+
+
+def race(*values):
+    return where('RACE_DESCR', 'in', values)
+
+
+def sfreq(*values):
+    return where('SFREQ', 'in', values)
+
+
+def min_stage_count(stage, n):
+    # stage is one of W, N1, N2, N3, R.
+    return where('STAGE_' + stage, '>=', n)
+
+
+def ahi_between(low, high):
+    # Events per hour of sleep, low included and high excluded.
+    return where('AHI', '>=', low) & where('AHI', '<', high)
+
+
+def has_channels(channels, resolve=True):
+    # With resolve, channels may be found under aliases or derived, see
+    # ss.montage, otherwise their exact names are required.
+    def func(df):
+        if resolve:
+            return df.STUDY.isin(ss.montage.available(channels))
+        return df.STUDY.isin(ss.edf.get_inventory().has_channels(channels))
+    return Predicate(func)
+
+
+def has_diagnosis(codes, prefix=False, column='DX_CODE'):
+    # With prefix, e.g. 'G47' matches every G47.x code.
+    codes = [codes] if isinstance(codes, str) else list(codes)
+
+    def func(df):
+        dx = get_diagnoses() if column == 'DX_CODE' else build_diagnoses(column)
+        values = dx[column].astype(str)
+        if prefix:
+            match = values.str.startswith(tuple(codes))
+        else:
+            match = values.isin(codes)
+        return df.STUDY_PAT_ID.isin(dx.STUDY_PAT_ID[match])
+
+    return Predicate(func)
+
+
+def query(predicate=None, df=None):
+    if df is None:
+        df = get_study_table()
+
+    if predicate is None:
+        return df.STUDY.tolist()
+
+    return df.STUDY[predicate(df)].tolist()
@@ -0,0 +1,245 @@
+import os
+import json
+import functools
+import numpy as np
+import pandas as pd
+
+import sleep_study as ss
+
+# A corpus is a directory holding all epochs of many studies back to back:
+#
+#   data.bin    (num epochs) by (num channels) by (num samples), raw array
+#   labels.bin  (num epochs), raw int8 array
+#   index.csv   study name and [start, stop) epoch offsets of every study
+#   meta.json   dtype, epoch shape, channel names and sampling rate
+#   stats.npz   per-study, per-channel statistics (see sleep_study.stats)
+#
+# Both arrays are opened with np.memmap, so indexing an epoch or a study only
+# touches the pages it needs and never decompresses anything.
+#
+# With dtype int16, data holds digital values (see sleep_study.epochs) at
+# half the size of float32, and meta.json the gain and offset of every study
+# and channel. Indexing the corpus then converts to float32, corpus.data
+# stays digital.
+
+DATA_FN = 'data.bin'
+LABELS_FN = 'labels.bin'
+INDEX_FN = 'index.csv'
+META_FN = 'meta.json'
+STATS_FN = 'stats.npz'
+
+
+class CorpusWriter:
+
+    def __init__(self, path, channels, sfreq, dtype='float32'):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        os.makedirs(self.path, exist_ok=True)
+
+        self.channels = list(channels)
+        self.sfreq = sfreq
+        self.dtype = np.dtype(dtype)
+
+        self.epoch_shape = None
+        self.index = []
+        self.stats = []
+        self.gain = []
+        self.offset = []
+        self.n_epochs = 0
+
+        # meta.json is written last, so an unfinished corpus can not be opened.
+        if os.path.exists(os.path.join(self.path, META_FN)):
+            os.remove(os.path.join(self.path, META_FN))
+
+        self.data_file = open(os.path.join(self.path, DATA_FN), 'wb')
+        self.labels_file = open(os.path.join(self.path, LABELS_FN), 'wb')
+
+    def add(self, name, data, labels, stats=None):
+        # stats of the study, e.g. computed by preprocess, are computed from
+        # data when not given.
+        assert len(data) == len(labels)
+        assert data.shape[1] == len(self.channels)
+
+        if self.epoch_shape is None:
+            self.epoch_shape = data.shape[1:]
+        assert data.shape[1:] == self.epoch_shape
+
+        if self.dtype == np.int16:
+            # Float data is quantized over its range.
+            if not isinstance(data, ss.epochs.Epochs):
+                data = ss.epochs.Epochs.quantize(data)
+
+            np.ascontiguousarray(data.digital).tofile(self.data_file)
+            self.gain.append(data.gain.tolist())
+            self.offset.append(data.offset.tolist())
+        else:
+            np.ascontiguousarray(data, dtype=self.dtype).tofile(self.data_file)
+
+        np.asarray(labels, dtype=np.int8).tofile(self.labels_file)
+
+        if stats is None:
+            stats = ss.stats.ChannelStats.from_data(data)
+        self.stats.append(stats)
+
+        self.index.append((name, self.n_epochs, self.n_epochs + len(data)))
+        self.n_epochs += len(data)
+
+    def close(self):
+        self.data_file.close()
+        self.labels_file.close()
+
+        index = pd.DataFrame(self.index, columns=['study', 'start', 'stop'])
+        index.to_csv(os.path.join(self.path, INDEX_FN), index=False)
+
+        if len(self.stats) > 0:
+            stats = ss.stats.ChannelStats.stack(self.stats)
+        else:
+            stats = ss.stats.ChannelStats.empty((0, len(self.channels)))
+        stats.save(os.path.join(self.path, STATS_FN))
+
+        meta = {
+                'dtype': self.dtype.str,
+                'epoch_shape': list(self.epoch_shape or (len(self.channels), 0)),
+                'n_epochs': self.n_epochs,
+                'channels': self.channels,
+                'sfreq': self.sfreq,
+                }
+
+        if self.dtype == np.int16:
+            meta['gain'] = self.gain
+            meta['offset'] = self.offset
+
+        with open(os.path.join(self.path, META_FN), 'w') as f:
+            json.dump(meta, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # After an error the corpus is left without meta.json, so it can not
+        # be opened.
+        if exc_type is None:
+            self.close()
+        else:
+            self.data_file.close()
+            self.labels_file.close()
+
+
+class Corpus:
+
+    def __init__(self, path, mode='r'):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.mode = mode
+
+        with open(os.path.join(self.path, META_FN)) as f:
+            meta = json.load(f)
+
+        self.channels = meta['channels']
+        self.sfreq = meta['sfreq']
+
+        shape = (meta['n_epochs'], *meta['epoch_shape'])
+
+        # np.memmap can not map empty files.
+        if meta['n_epochs'] > 0:
+            self.data = np.memmap(os.path.join(self.path, DATA_FN), dtype=meta['dtype'], mode=mode, shape=shape)
+            self.labels = np.memmap(os.path.join(self.path, LABELS_FN), dtype=np.int8, mode=mode, shape=shape[:1])
+        else:
+            self.data = np.empty(shape, dtype=meta['dtype'])
+            self.labels = np.empty(0, dtype=np.int8)
+
+        index = pd.read_csv(os.path.join(self.path, INDEX_FN), dtype={'study': 'str'})
+        self.studies = index.study.tolist()
+        self.offsets = np.append(index.start.values, meta['n_epochs']).astype(np.int64)
+        self.study_ids = {name: i for i, name in enumerate(self.studies)}
+
+        # (num studies) by (num channels) scaling of digital data, or None.
+        self.gain = self.offset = None
+        if 'gain' in meta:
+            shape = (len(self.studies), len(self.channels))
+            self.gain = np.array(meta['gain'], dtype=np.float64).reshape(shape)
+            self.offset = np.array(meta['offset'], dtype=np.float64).reshape(shape)
+
+        self.stats = None # Loaded on first use by get_stats().
+
+    def __reduce__(self):
+        # Reopened from the path instead of pickling the mapped arrays, e.g.
+        # when sent to DataLoader or pool workers.
+        return (Corpus, (self.path, self.mode))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if self.gain is None:
+            return self.data[idx], self.labels[idx]
+
+        # Digital values of every epoch scaled with the gain and offset of its study.
+        if isinstance(idx, slice):
+            epochs = np.arange(*idx.indices(len(self)))
+        else:
+            epochs = np.asarray(idx)
+            epochs = np.flatnonzero(epochs) if epochs.dtype == bool else epochs % len(self)
+
+        study_ids = self.study_of_epoch(epochs)
+        data = np.asarray(self.data[idx], dtype=np.float32)
+        data *= self.gain[study_ids, :, np.newaxis].astype(np.float32)
+        data += self.offset[study_ids, :, np.newaxis].astype(np.float32)
+        return data, self.labels[idx]
+
+    def study_slice(self, name):
+        i = self.study_ids[name] if isinstance(name, str) else name
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def study(self, name):
+        # Returns views into the memory-mapped arrays, no data is copied. Of
+        # an int16 corpus, data is ss.epochs.Epochs, converted when read.
+        idx = self.study_slice(name)
+        if self.gain is None:
+            return self[idx]
+
+        i = self.study_ids[name] if isinstance(name, str) else name
+        return ss.epochs.Epochs(self.data[idx], self.gain[i], self.offset[i]), self.labels[idx]
+
+    def get_stats(self, name=None):
+        # Statistics of one study, or with None (num studies) by (num
+        # channels) statistics of all of them; .reduce() merges them into
+        # corpus-level ones.
+        if self.stats is None:
+            self.stats = ss.stats.ChannelStats.load(os.path.join(self.path, STATS_FN))
+
+        if name is None:
+            return self.stats
+        return self.stats[self.study_ids[name] if isinstance(name, str) else name]
+
+    def study_lengths(self):
+        return np.diff(self.offsets)
+
+    def study_of_epoch(self, idx):
+        return np.searchsorted(self.offsets, idx, side='right') - 1
+
+
+def write_corpus(path, studies=None, channels=ss.info.EEG_CH_NAMES, load=None, dtype='float32', n_prefetch=2,
+                 memory_limit=None, verbose=True):
+    # The next n_prefetch studies are loaded in the background while the
+    # current one is written, see ss.prefetch. Studies which fail to load
+    # are reported and left out.
+    if studies is None:
+        studies = ss.data.study_list
+
+    if load is None:
+        load = functools.partial(ss.data.get_sleep_eeg_and_stages, channels=channels,
+                                 compact=np.dtype(dtype) == np.int16)
+
+    with CorpusWriter(path, channels, ss.info.REFERENCE_FREQ, dtype) as writer:
+        for i, (name, res, error) in enumerate(ss.prefetch.iter_studies(load, studies, n_prefetch, memory_limit)):
+
+            if (i % 10 == 0) and verbose:
+                print('Processing %d of %d' % (i, len(studies)))
+
+            if error is not None:
+                print('Failed %s:\n%s' % (name, error))
+                continue
+
+            data, labels = res
+            writer.add(name, data, labels)
+
+    return Corpus(path)
@@ -1,60 +1,267 @@
-import mne
 import os
+import json
+import shutil
+import hashlib
+import threading
 import pandas as pd
 import numpy as np
-from dateutil import parser
-from datetime import timezone
-import pywt
-from scipy import signal, interpolate
+from datetime import datetime, timezone
 
 import sleep_study as ss
 
 study_list = None # Will be initialized after the module is initialized.
+age_table = None # FILE_NAME and AGE_AT_SLEEP_STUDY_DAYS of every study, built by ss.init().
+cache_size_limit = 50 * 1024**3 # bytes, least recently used entries are evicted beyond this.
+cache_index = None # path -> [last use, bytes] of the entries, built on the first store.
+cache_bytes = 0
+
+# Kinds stored through cached(), the only directories eviction looks at.
+CACHE_KINDS = ['epochs']
+
+_cache_lock = threading.Lock()
 
 def clean_ch_names(ch_names):
     return [x.upper() for x in ch_names]
 
 def init_study_list():
     path = os.path.join(ss.data_dir, 'Sleep_Data')
-    return [x[:-4] for x in os.listdir(path) if x.endswith('edf')]
+    if ss.cache_dir is None:
+        return [x[:-4] for x in os.listdir(path) if x.endswith('edf')]
+
+    # Listing the data directory is slow on network file systems, so the
+    # list is kept until files are added to or removed from the directory.
+    memo_path = os.path.join(ss.cache_dir, 'study_list.json')
+    stamp = [path, os.stat(path).st_mtime_ns]
+
+    try:
+        with open(memo_path) as f:
+            memo = json.load(f)
+        if memo['stamp'] == stamp:
+            return memo['studies']
+    except (OSError, ValueError):
+        pass
+
+    studies = [x[:-4] for x in os.listdir(path) if x.endswith('edf')]
+
+    os.makedirs(ss.cache_dir, exist_ok=True)
+    with open(memo_path + '.tmp', 'w') as f:
+        json.dump({'stamp': stamp, 'studies': studies}, f)
+    os.replace(memo_path + '.tmp', memo_path)
+
+    return studies
+
+def init_age_table():
+    df = ss.info.SLEEP_STUDY
+    age_table = pd.DataFrame({
+        'FILE_NAME': df.STUDY_PAT_ID.astype(str) + '_' + df.SLEEP_STUDY_ID.astype(str),
+        'AGE_AT_SLEEP_STUDY_DAYS': df.AGE_AT_SLEEP_STUDY_DAYS.astype(int),
+        })
+    return age_table
 
 def init_age_file():
-    new_fn = 'age_file.csv'
-    age_path = os.path.join(ss.data_dir, 'Health_Data', ss.info.SLEEP_STUDY)   
-
-    df = pd.read_csv(age_path, sep=',', dtype='str')
-    df['FILE_NAME'] = df["STUDY_PAT_ID"].str.cat(df["SLEEP_STUDY_ID"], sep='_')
-
-    df.to_csv(new_fn, columns=["FILE_NAME", "AGE_AT_SLEEP_STUDY_DAYS"], index=False)
-    return os.path.abspath(new_fn)
+    # Writes the age table to the cache directory, for use outside the package.
+    new_fn = os.path.join(ss.cache_dir, 'age_file.csv')
+    age_path = os.path.join(ss.data_dir, 'Health_Data', ss.info.SLEEP_STUDY_NAME)
+
+    if not os.path.exists(new_fn) or os.path.getmtime(new_fn) < os.path.getmtime(age_path):
+        os.makedirs(ss.cache_dir, exist_ok=True)
+        age_table.to_csv(new_fn + '.tmp', index=False)
+        os.replace(new_fn + '.tmp', new_fn)
+
+    return new_fn
+
+# Disk cache. Entries live in ss.cache_dir/<kind>/<study>/<key>/ as plain .npy
+# files (so they can be memory-mapped), plus a meta.json recording the
+# mtime/size of the study's .edf and .tsv. The cache is disabled when
+# ss.cache_dir is None.
+#
+# The size of the entries is kept in a running index, so a store does not
+# walk the cache. Entries written by other processes are only seen when the
+# index is built again, which eviction does before removing anything.
+
+def source_stamp(name):
+    stamp = []
+    for ext in ['.edf', '.tsv']:
+        st = os.stat(os.path.join(ss.data_dir, 'Sleep_Data', name + ext))
+        stamp.append([st.st_mtime_ns, st.st_size])
+    return stamp
+
+def cache_path(kind, name, params):
+    if kind not in CACHE_KINDS:
+        raise ValueError('Unknown cache kind %s, add it to CACHE_KINDS' % kind)
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(ss.cache_dir, kind, name, key)
+
+def entry_size(path):
+    return sum(x.stat().st_size for x in os.scandir(path) if x.is_file())
+
+def scan_cache():
+    # Entries of every kind, with the time they were last used and their size.
+    index = {}
+    for kind in CACHE_KINDS:
+        root = os.path.join(ss.cache_dir, kind)
+        if not os.path.isdir(root):
+            continue
+
+        for study in os.scandir(root):
+            if not study.is_dir():
+                continue
+            for entry in os.scandir(study.path):
+                # Unfinished stores of this or another process are left alone.
+                if entry.name.endswith('.tmp') or not os.path.exists(os.path.join(entry.path, 'meta.json')):
+                    continue
+                try:
+                    index[entry.path] = [entry.stat().st_mtime, entry_size(entry.path)]
+                except OSError:
+                    # Removed in the meantime.
+                    pass
+
+    return index
+
+def cache_load(path, stamp, mmap_mode='c'):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # The source files changed since the entry was written.
+    if meta['stamp'] != stamp:
+        shutil.rmtree(path, ignore_errors=True)
+        cache_forget(path)
+        return None
+
+    arrays = [np.load(os.path.join(path, '%d.npy' % i), mmap_mode=mmap_mode)
+              for i in range(meta['n_arrays'])]
+
+    # Mark as recently used for LRU eviction.
+    os.utime(path)
+    with _cache_lock:
+        if cache_index is not None and path in cache_index:
+            cache_index[path][0] = os.path.getmtime(path)
+    return arrays
+
+def cache_store(path, stamp, arrays):
+    global cache_bytes
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+
+    for i, x in enumerate(arrays):
+        np.save(os.path.join(tmp_path, '%d.npy' % i), x)
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'stamp': stamp, 'n_arrays': len(arrays)}, f)
+
+    size = entry_size(tmp_path)
+
+    # Swap the finished entry in, so readers never see a partial one.
+    shutil.rmtree(path, ignore_errors=True)
+    cache_forget(path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process stored the same entry first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+
+    with _cache_lock:
+        if cache_index is not None:
+            cache_index[path] = [os.path.getmtime(path), size]
+            cache_bytes += size
+
+    cache_evict()
+
+def cache_forget(path):
+    global cache_bytes
+
+    with _cache_lock:
+        if cache_index is not None and path in cache_index:
+            cache_bytes -= cache_index.pop(path)[1]
+
+def cache_evict(limit=None):
+    global cache_index, cache_bytes
+
+    if limit is None:
+        limit = cache_size_limit
+
+    with _cache_lock:
+        if cache_index is not None and cache_bytes <= limit:
+            return
+
+        # Built again, with the entries and last uses of other processes.
+        cache_index = scan_cache()
+        cache_bytes = sum(size for _, size in cache_index.values())
+
+        for _, path in sorted((x[0], path) for path, x in cache_index.items()):
+            if cache_bytes <= limit:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            cache_bytes -= cache_index.pop(path)[1]
+
+def cached(kind, name, params, compute):
+    if ss.cache_dir is None:
+        return compute()
+
+    stamp = source_stamp(name)
+    path = cache_path(kind, name, params)
+
+    arrays = cache_load(path, stamp)
+    if arrays is None:
+        arrays = compute()
+        cache_store(path, stamp, arrays)
+
+    return arrays
+
+
+def load_study(name, preload=False, exclude=[], verbose='CRITICAL', channels=None, tmin=None, tmax=None):
+    # With channels, only those are kept (resolved through ss.montage, so a
+    # derived channel keeps its sources), all others are excluded from the
+    # header and never decoded. Channels keep their sampling rate, mne only
+    # upsamples to the highest rate among the kept ones. tmin and tmax (in
+    # seconds) crop the recording before any data is loaded, annotations not
+    # wholly inside the range are dropped, so no stage is cut short. Like
+    # for any cropped mne recording, events_from_annotations then counts
+    # samples from the start of the file: subtract raw.first_samp before
+    # indexing the data, e.g. for extract_epochs.
+    with ss.profiling.timer('load_study', name) as t:
+        raw = _load_study(name, preload, exclude, verbose, channels, tmin, tmax)
+
+        # Decoded samples, when they are loaded. Otherwise they are read,
+        # and counted, later, e.g. by extract_epochs.
+        if preload:
+            t.bytes = raw.n_times * len(raw.ch_names) * 8
 
+    return raw
 
-def load_study(name, preload=False, exclude=[], verbose='CRITICAL'):
+def _load_study(name, preload, exclude, verbose, channels, tmin, tmax):
+    import mne
     path = os.path.join(ss.data_dir, 'Sleep_Data', name + '.edf')
     path = os.path.abspath(path)
     # file_size = os.stat(path).st_size / 1024 / 1024
 
-    raw = mne.io.edf.edf.RawEDF(input_fname=path, exclude=exclude, preload=preload,
-                                verbose=verbose)
+    if channels is not None:
+        exclude = list(exclude) + get_excluded_labels(name, channels)
 
-    patient_id, study_id = name.split('_')
+    crop = tmin is not None or tmax is not None
+    raw = mne.io.read_raw_edf(path, exclude=exclude, preload=preload and not crop, verbose=verbose)
 
-    tmp = ss.info.SLEEP_STUDY
-    date = tmp[(tmp.STUDY_PAT_ID == int(patient_id))
-             & (tmp.SLEEP_STUDY_ID == int(study_id))] \
-                     .SLEEP_STUDY_START_DATETIME.values[0] \
-                     .split()[0]
-
-    time = str(raw.info['meas_date']).split()[1][:-6]
+    # The date comes from SLEEP_STUDY, the time of day from the EDF header.
+    patient_id, study_id = name.split('_')
+    date = ss.info.SLEEP_STUDY_DATES[(int(patient_id), int(study_id))]
 
-    new_datetime = parser.parse(date + ' ' + time + ' UTC') \
-                         .replace(tzinfo=timezone.utc)
+    new_datetime = datetime.combine(date, raw.info['meas_date'].time()) \
+                           .replace(tzinfo=timezone.utc)
 
     raw.set_meas_date(new_datetime)
     # raw._raw_extras[0]['meas_date'] = new_datetime
 
-    annotation_path = os.path.join(ss.data_dir, 'Sleep_Data', name + '.tsv')
-    df = pd.read_csv(annotation_path, sep='\t')
+    df = ss.annotations.get_annotations(name)
+    if crop:
+        start = 0 if tmin is None else tmin
+        stop = np.inf if tmax is None else tmax
+        df = df[(df.onset >= start) & (df.onset + df.duration <= stop)]
+
     annotations = mne.Annotations(df.onset, df.duration, df.description,
                                   orig_time=new_datetime)
 
@@ -62,10 +269,117 @@ def load_study(name, preload=False, exclude=[], verbose='CRITICAL'):
 
     raw.rename_channels({name: name.upper() for name in raw.info['ch_names']})
 
+    if crop:
+        raw.crop(0 if tmin is None else tmin, tmax)
+        if preload:
+            raw.load_data(verbose=verbose)
+
     return raw
 
-def get_sleep_eeg_and_stages(name, channels=ss.info.EEG_CH_NAMES, verbose=False, downsample=True):
-    raw = ss.data.load_study(name)
+def get_excluded_labels(name, channels):
+    # Header labels, in their original case, of the channels not needed for
+    # channels.
+    header = ss.edf.read_header(ss.edf.edf_path(name))
+    labels = [x for x in header['labels'] if x != ss.edf.ANNOTATION_LABEL]
+
+    plan = ss.montage.resolve_all(channels, labels)
+    sources, _ = ss.montage.plan_matrix(plan, channels)
+
+    return [x for x in labels if x.upper() not in sources]
+
+def get_study_start_datetimes(studies=None):
+    # Same as the meas_date set by load_study, for many studies at once and
+    # without opening them: date from SLEEP_STUDY, time of day from the header.
+    df = ss.edf.get_inventory().studies
+    if studies is not None:
+        df = df.set_index('study').loc[list(studies)].reset_index()
+
+    ids = df.study.str.split('_', expand=True).astype(int)
+    dates = pd.to_datetime(pd.Series([ss.info.SLEEP_STUDY_DATES[x] for x in zip(ids[0], ids[1])]))
+    times = df.start - df.start.dt.normalize()
+
+    res = (dates + times).dt.tz_localize('UTC')
+    res.index = df.study.values
+    return res
+
+def extract_epochs(raw, channels, onsets, length, start=0, stop=None):
+    # Read the requested channels in one pass and slice all epochs out of
+    # each channel with a single fancy index, instead of one small read per epoch.
+    # Only samples in [start, stop) are read, all epochs must lie inside.
+    with ss.profiling.timer('extract') as t:
+        signals = raw.get_data(channels, start=start, stop=stop)
+        indices = (onsets - start)[:, np.newaxis] + np.arange(length)
+
+        data = np.empty((len(onsets), len(channels), length), dtype=signals.dtype)
+        for i in range(len(channels)):
+            data[:, i, :] = signals[i][indices]
+
+        t.bytes = signals.nbytes
+        t.epochs = len(onsets)
+
+    # data is (num epochs) by (num channels) by (length)
+    return data
+
+def get_channel_names(name):
+    # From the EDF header only, no signal data is read.
+    if ss.edf.inventory is not None and name in ss.edf.inventory.stamps:
+        return ss.edf.inventory.channel_names(name)
+
+    return ss.edf.read_channel_names(name)
+
+def get_sleep_eeg_and_stages(name, channels=ss.info.EEG_CH_NAMES, verbose=False, downsample=True, cache=True,
+                             compact=False):
+    # With compact, data is ss.epochs.Epochs, int16 with the scaling of the
+    # EDF header, and cached as such.
+    if not cache:
+        data, labels = _get_sleep_eeg_and_stages(name, channels, verbose, downsample)
+        return (compact_epochs(name, channels, data), labels) if compact else (data, labels)
+
+    params = {
+            'channels': list(channels),
+            'downsample': ss.resample.DEFAULT_METHOD if downsample is True else downsample,
+            'reference_freq': ss.info.REFERENCE_FREQ,
+            'interval': ss.info.INTERVAL,
+            }
+
+    if compact:
+        params['compact'] = True
+
+        def compute():
+            data, labels = _get_sleep_eeg_and_stages(name, channels, verbose, downsample)
+            data = compact_epochs(name, channels, data)
+            return data.digital, data.gain, data.offset, labels
+
+        digital, gain, offset, labels = cached('epochs', name, params, compute)
+        return ss.epochs.Epochs(digital, gain, offset), labels
+
+    def compute():
+        return _get_sleep_eeg_and_stages(name, channels, verbose, downsample)
+
+    data, labels = cached('epochs', name, params, compute)
+    return data, labels
+
+def get_header_scaling(name, channels):
+    # Gain and offset of channels from the EDF header, derived channels
+    # included, see ss.epochs.
+    header = ss.edf.read_header(ss.edf.edf_path(name))
+    labels = [x for x in header['labels'] if x != ss.edf.ANNOTATION_LABEL]
+
+    sources, weights = ss.montage.plan_matrix(ss.montage.resolve_all(channels, labels), channels)
+    gain, offset = ss.epochs.header_scaling(header, sources)
+    return ss.epochs.derived_scaling(gain, offset, weights)
+
+def compact_epochs(name, channels, data):
+    return ss.epochs.Epochs.quantize(data, *get_header_scaling(name, channels))
+
+def _get_sleep_eeg_and_stages(name, channels, verbose, downsample):
+    import mne
+
+    # Channels missing under their exact name are read through aliases or
+    # derived from other derivations, see ss.montage. Only the sources are
+    # decoded.
+    sources, weights = ss.montage.plan_matrix(ss.montage.get_plan(name, channels), channels)
+    raw = ss.data.load_study(name, channels=sources)
     
     freq = int(raw.info['sfreq']) # 256, 400, 512
     n_samples = raw.n_times
@@ -74,68 +388,81 @@ def get_sleep_eeg_and_stages(name, channels=ss.info.EEG_CH_NAMES, verbose=False,
         print('sampling rate:', freq, 'Hz')
         print('channel names:', raw.info['ch_names'])
         print( )
-        sleep_stage_stats = ss.data.sleep_stage_stats([study])
+        sleep_stage_stats = ss.data.sleep_stage_stats([name])
         print( )
     
     events, event_id = mne.events_from_annotations(raw, event_id = ss.info.EVENT_DICT, verbose=verbose)
-    
-    labels = []
-    data = []
-    
-    for event in events:
-        label, onset = event[[2, 0]]
-        
-        # get 30 seconds of data corresponding to the label
-        indices = [onset, onset + ss.info.INTERVAL*freq]
-        
-        if indices[1] <= n_samples:
-            interval_data = raw.get_data(channels, start=indices[0], stop=indices[1]) 
-            data.append(interval_data) 
-            labels.append(label)
-            # sometimes the last interval seems to go over the length of the data and cause problems.
-            # it's probably okay to just skip those for now.
-   
-    labels = np.array(labels)
-    data = np.array(data)
-        
-    # Downsample to 128Hz
+
+    # get 30 seconds of data corresponding to each label
+    length = ss.info.INTERVAL * freq
+
+    # sometimes the last interval seems to go over the length of the data and cause problems.
+    # it's probably okay to just skip those for now.
+    events = events[events[:, 0] + length <= n_samples]
+    labels = events[:, 2]
+    data = extract_epochs(raw, sources, events[:, 0], length)
+    data = ss.montage.apply_weights(data, weights)
+
     if downsample:
-        if freq % ss.info.REFERENCE_FREQ == 0:
-            k = freq//ss.info.REFERENCE_FREQ
-            data = data[:,:,::k]
+        data = downsample_epochs(data, freq, downsample)
 
-        elif freq != ss.info.REFERENCE_FREQ:
-            x = np.linspace(0, ss.info.INTERVAL, num=ss.info.INTERVAL*freq)
-            new_x = np.linspace(0, ss.info.INTERVAL, num=ss.info.INTERVAL*ss.info.REFERENCE_FREQ)
+    # data is (num events) by (num channels) by (30s x ss.info.REFERENCE_FREQ)
+    return data, labels
 
-            f = interpolate.interp1d(x, data, kind='linear', axis= -1, assume_sorted=True)
-            data = f(new_x)   
-    
-    # data is (num events) by (num channels) by (30s x ss.info.REFERENCE_FREQ)            
-    return np.array(data), labels
+def downsample_epochs(data, freq, method=True):
+    # Downsample to 128Hz, method True picks the default resampling method
+    if method is True:
+        method = ss.resample.DEFAULT_METHOD
 
-def get_demo_wavelet_features(data, n=4, level=2):
-    
-    def get_stats(x, axis=-1):
-        stats = []
-        stats.extend(np.expand_dims(np.mean(x, axis), 0))
-        stats.extend(np.expand_dims(np.std(x, axis), 0))
-        stats.extend(np.expand_dims(np.min(x, axis),0))
-        stats.extend(np.expand_dims(np.max(x, axis),0))
-
-        return np.array(stats)   
-    
-    coeffs = pywt.wavedec(data, 'db%d' % n, level=level, axis=-1)
+    return ss.resample.resample_epochs(data, freq, ss.info.REFERENCE_FREQ, method)
+
+def iter_sleep_eeg_and_stages(name, channels=ss.info.EEG_CH_NAMES, batch_size=64, downsample=True, compact=False):
+    # Yields (data, labels) batches of at most batch_size epochs. Each batch
+    # is read from a window of at most batch_size epochs of signal, so peak
+    # memory does not grow with the length of the night. With compact,
+    # batches are ss.epochs.Epochs as in get_sleep_eeg_and_stages.
+    import mne
+    sources, weights = ss.montage.plan_matrix(ss.montage.get_plan(name, channels), channels)
+    raw = load_study(name, channels=sources)
+
+    if compact:
+        gain, offset = get_header_scaling(name, channels)
+
+    freq = int(raw.info['sfreq'])
+    length = ss.info.INTERVAL * freq
+
+    events, event_id = mne.events_from_annotations(raw, event_id=ss.info.EVENT_DICT, verbose=False)
+    events = events[events[:, 0] + length <= raw.n_times]
+
+    max_window = batch_size * length
+
+    i = 0
+    while i < len(events):
+        start = events[i, 0]
+
+        # Stop the batch early when gaps between events would make the window too long.
+        j = i + 1
+        while j < len(events) and j - i < batch_size and events[j, 0] + length - start <= max_window:
+            j += 1
 
-    # coeffs is a list of length (level+1)
-    # coeffs[i] is an array of size (data.shape[0] == num events) by (data.shape[1] == num channels) by (-1)
-    res = []
+        batch = events[i:j]
+        data = extract_epochs(raw, sources, batch[:, 0], length, start, batch[-1, 0] + length)
+        data = ss.montage.apply_weights(data, weights)
 
-    for i in range(len(coeffs)):
-        stats = get_stats(coeffs[i]) # this has (num stats) by (num events) by (num channels)
-        res.extend(stats)    
+        if downsample:
+            data = downsample_epochs(data, freq, downsample)
 
-    return np.array(res).transpose((1, 2, 0))
+        if compact:
+            data = ss.epochs.Epochs.quantize(data, gain, offset)
+
+        yield data, batch[:, 2]
+        i = j
+
+def get_demo_wavelet_features(data, n=4, level=2):
+    # mean, std, min and max of each wavelet level, the result is
+    # (num events) by (num channels) by (4 x (level + 1))
+    features, _ = ss.features.get_features(data, n=n, level=level, bands=[])
+    return features
 
 def get_demo_wavelet_features_and_labels(name):
     data, labels = get_sleep_eeg_and_stages(name)
@@ -143,50 +470,32 @@ def get_demo_wavelet_features_and_labels(name):
     
     return features, labels
 
-def channel_stats(verbose=True):
-    study_ch_names = {}
-
-    for i, study in enumerate(study_list):
+def iter_demo_wavelet_features_and_labels(studies=None, n_prefetch=2, memory_limit=None):
+    # Yields (name, features, labels) of every study, reading the next
+    # studies in the background, see ss.prefetch. Studies which fail to load
+    # are reported and skipped.
+    for name, res, error in ss.prefetch.iter_studies(get_sleep_eeg_and_stages, studies, n_prefetch, memory_limit):
+        if error is not None:
+            print('Failed %s:\n%s' % (name, error))
+            continue
 
-        if (i % 10 == 0) and verbose:
-            print('Processing %d of %d' % (i, len(study_list)))
+        data, labels = res
+        yield name, get_demo_wavelet_features(data), labels
 
-        raw = load_study(study)
-        study_ch_names[study] = raw.ch_names
-
-    names = {}
-    for y in study_ch_names.values():
-        for x in y:
-            x = x.upper()
-            try:
-                names[x] += 1
-            except:
-                names[x] = 1
-
-    names = {k: v for k, v in sorted(names.items(), key=lambda item: item[1], reverse=True)}
+def channel_stats(verbose=True):
+    counts = ss.edf.get_inventory(verbose=verbose).channel_counts()
+    names = {k: int(v) for k, v in counts.items()}
 
     print('\n'.join('%-20s %4d &  %.2f%%\\' % (k, v, v / len(study_list) * 100) for k, v in names.items()))
     return names
 
 
 def sleep_stage_stats(studies=[]):
-    res = {k.lower(): 0 for k in ss.info.EVENT_DICT}
     if len(studies)<1:
         studies = study_list
-        
-    for i, study in enumerate(studies):
-
-        if (i + 1) % 100 == 0:
-            print('Processed %d of %d' % (i + 1, len(studies)))
-
-        annotation_path = os.path.join(ss.data_dir, 'Sleep_Data', study+ '.tsv')
-        df = pd.read_csv(annotation_path, sep='\t')
 
-        for event in df.description.tolist():
-            try:
-                res[event.lower()] += 1
-            except:
-                pass
+    counts = ss.annotations.stage_counts(studies).sum()
+    res = {k.lower(): int(v) for k, v in counts.items()}
 
     total = sum(res.values())
 
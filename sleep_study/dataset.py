@@ -1,67 +1,203 @@
 import os
+import json
+import hashlib
+import subprocess
 import pandas as pd
 from time import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import sleep_study as ss
 
 def check_annotations(df):
-    event_dict = {k.lower(): 0 for k in ss.info.EVENT_DICT.keys()}
+    stages = [k.lower() for k in ss.info.EVENT_DICT.keys()]
+    return df.description.astype(str).str.lower().isin(stages).any()
 
-    for x in df.description:
-        try:
-            event_dict[x.lower()] += 1
-        except:
-            pass
+def get_broken_studies(studies=None):
+    # Studies without any labeled sleep stage.
+    if studies is None:
+        studies = ss.data.study_list
 
-    return any(event_dict.values())
+    counts = ss.annotations.stage_counts(studies)
+    return counts.index[counts.sum(axis=1) == 0].tolist()
 
 
-def create_dataset(output_dir='~/sleep_study_dataset'):
-    output_dir = os.path.abspath(os.path.expanduser(output_dir))
+# Compressors for create_dataset: command line given a level, and extension.
+CODECS = {
+        'xz': (lambda level: ['xz', '-T1', '-%d' % level], '.tar.xz'),
+        'gzip': (lambda level: ['gzip', '-%d' % level], '.tar.gz'),
+        'zstd': (lambda level: ['zstd', '-q', '-T1', '-%d' % level], '.tar.zst'),
+        }
 
-    broken = []
-    total = len(ss.data.study_list)
+MANIFEST_FN = 'manifest.jsonl'
 
-    for i, name in enumerate(ss.data.study_list):
+def _file_stamps(root, files):
+    stamps = []
+    for x in files:
+        st = os.stat(os.path.join(root, x))
+        stamps.append([x, st.st_mtime_ns, st.st_size])
+    return stamps
 
-        if i % 100 == 0:
-            print('Processing %d of %d' % (i, total))
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
 
-        path = os.path.join(ss.data_dir, 'Sleep_Data', name + '.tsv')
-        df = pd.read_csv(path, sep='\t')
+def _compress(job, codec, level):
+    # tar the inputs and pipe them through the compressor into a temporary
+    # file, which replaces the output only when both processes succeeded.
+    name, root, files, output_path = job
 
-        if check_annotations(df) == False:
-            broken.append(name)
+    with ss.profiling.timer('compress', name) as t:
+        record = _run_compressor(name, root, files, output_path, codec, level)
 
-    print('Processd %d files' % i)
-    print('%d files have no labeled sleeping stage' % len(broken))
+        t.bytes = record.get('input_size', 0)
+        t.error = record.get('error')
+
+    return record
+
+def _run_compressor(name, root, files, output_path, codec, level):
+    command, _ = CODECS[codec]
+
+    start = time()
+    tmp_path = output_path + '.tmp'
+
+    tar = None
+    with open(tmp_path, 'wb') as f:
+        try:
+            tar = subprocess.Popen(['tar', '-cf', '-'] + files, cwd=root, stdout=subprocess.PIPE)
+            compressor = subprocess.Popen(command(level), stdin=tar.stdout, stdout=f)
+        except OSError as e:
+            # tar or the codec binary is missing.
+            if tar is not None:
+                tar.kill()
+                tar.stdout.close()
+                tar.wait()
+            f.close()
+            os.remove(tmp_path)
+            return {'name': name, 'status': 'failure', 'error': str(e)}
+
+        tar.stdout.close()
+        compressor.wait()
+        tar.wait()
+
+    if tar.returncode != 0 or compressor.returncode != 0:
+        os.remove(tmp_path)
+        return {'name': name, 'status': 'failure',
+                'error': 'tar exited with %d, %s with %d' % (tar.returncode, codec, compressor.returncode)}
+
+    os.replace(tmp_path, output_path)
+
+    seconds = time() - start
+    input_size = sum(x[2] for x in _file_stamps(root, files))
+
+    return {
+            'name': name,
+            'status': 'success',
+            'stamps': _file_stamps(root, files),
+            'codec': codec,
+            'level': level,
+            'sha256': _sha256(output_path),
+            'input_size': input_size,
+            'output_size': os.path.getsize(output_path),
+            'seconds': seconds,
+            'mb_per_second': input_size / 1024**2 / max(seconds, 1e-6),
+            }
+
+def _up_to_date(record, job, codec, level, verify):
+    name, root, files, output_path = job
+
+    if record is None or record['status'] != 'success' or not os.path.exists(output_path):
+        return False
+
+    if (record['codec'], record['level']) != (codec, level):
+        return False
+
+    if record['stamps'] != _file_stamps(root, files):
+        return False
+
+    if os.path.getsize(output_path) != record['output_size']:
+        return False
+
+    return not verify or _sha256(output_path) == record['sha256']
+
+def create_dataset(output_dir='~/sleep_study_dataset', n_jobs=None, codec='xz', level=6, verify=False):
+    # Archives Health_Data and every study with labeled sleep stages, on
+    # n_jobs concurrent compressors, largest inputs first. Outputs listed in
+    # output_dir/manifest.jsonl with unchanged inputs and settings are kept,
+    # with verify their sha256 is checked as well.
+    output_dir = os.path.abspath(os.path.expanduser(output_dir))
+    os.makedirs(os.path.join(output_dir, 'Sleep_Data'), exist_ok=True)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    _, ext = CODECS[codec]
 
-    path = os.path.join(output_dir, 'Sleep_Data')
-    _ = os.popen('mkdir -p ' + path).read()
+    broken = set(get_broken_studies())
+    total = len(ss.data.study_list)
 
-    output_path = os.path.join(output_dir, 'Sleep_Data.tar.xz')
-    cmd = 'cd %s && tar -cf - Health_Data | xz -T0 > %s' % (ss.data_dir, output_path)
+    print('Processd %d files' % total)
+    print('%d files have no labeled sleeping stage' % len(broken))
 
-    print('Compressing health data')
+    sleep_data = os.path.join(ss.data_dir, 'Sleep_Data')
+    health_data = [os.path.join('Health_Data', x) for x in sorted(os.listdir(os.path.join(ss.data_dir, 'Health_Data')))]
+
+    jobs = [('Health_Data', ss.data_dir, health_data, os.path.join(output_dir, 'Health_Data' + ext))]
+    jobs += [(name, sleep_data, [name + '.edf', name + '.tsv'], os.path.join(output_dir, 'Sleep_Data', name + ext))
+             for name in ss.data.study_list if name not in broken]
+
+    manifest_path = os.path.join(output_dir, MANIFEST_FN)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                manifest[record['name']] = record
+
+    todo = [job for job in jobs if not _up_to_date(manifest.get(job[0]), job, codec, level, verify)]
+    print('%d of %d archives are up to date' % (len(jobs) - len(todo), len(jobs)))
+
+    # Largest first, so the last running jobs are short ones.
+    def input_size(job):
+        return sum(x[2] for x in _file_stamps(job[1], job[2]))
+    todo.sort(key=input_size, reverse=True)
+
+    records = []
     start = time()
-    _ = os.popen(cmd).read()
+
+    with open(manifest_path, 'a') as f, ThreadPoolExecutor(n_jobs) as pool:
+        futures = [pool.submit(_compress, job, codec, level) for job in todo]
+
+        for i, future in enumerate(as_completed(futures)):
+            record = future.result()
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            records.append(record)
+
+            if record['status'] == 'success':
+                print('Compressed %s, %d of %d, %.1f MB in %.2f seconds, %.1f MB/s' % (
+                    record['name'], i + 1, len(todo), record['input_size'] / 1024**2,
+                    record['seconds'], record['mb_per_second']))
+            else:
+                print('Failed %s: %s' % (record['name'], record['error']))
+
     end = time()
-    print('Compressed, used %.2f seconds' % (end - start))
-     
-    for i, name in enumerate(ss.data.study_list):
-        cmd = 'cd %s/Sleep_Data && tar -cf - %s* | xz -T0 > %s/Sleep_Data/%s.tar.xz' % (ss.data_dir, name, output_dir, name)
-
-        print('Compressing %s.edf and %s.tsv, %d of %d' % (name, name, i + 1, total))
-        start = time()
-        _ = os.popen(cmd).read()
-        end = time()
-        print('Compressed, used %.2f seconds' % (end - start))
-
-
-def get_studies_by_patient_age(low, high, txt_path='age_file.csv'):
-    study_list = []
-    ages = []
-    df = pd.read_csv(txt_path, sep=",", dtype={'FILE_NAME': 'str', 'AGE_AT_SLEEP_STUDY_DAYS': 'int'})
+    size = sum(x['input_size'] for x in records if x['status'] == 'success')
+    print('Compressed %.1f MB in %.2f seconds, %.1f MB/s' % (size / 1024**2, end - start, size / 1024**2 / max(end - start, 1e-6)))
+
+    return records
+
+
+def get_studies_by_patient_age(low, high, txt_path=None):
+    if txt_path is None:
+        df = ss.data.age_table
+    else:
+        df = pd.read_csv(txt_path, sep=",", dtype={'FILE_NAME': 'str', 'AGE_AT_SLEEP_STUDY_DAYS': 'int'})
     
     df = df[(df.AGE_AT_SLEEP_STUDY_DAYS >= low*365) & (df.AGE_AT_SLEEP_STUDY_DAYS < high*365)]
     print("found", len(df), "patients between", low, "(incl.) and", high, "(excl.) years old.")
@@ -71,20 +207,9 @@ def get_studies_by_patient_age(low, high, txt_path='age_file.csv'):
 def annotation_stats():
     output_dir = './'
 
-    broken = []
+    broken = get_broken_studies()
     total = len(ss.data.study_list)
 
-    for i, name in enumerate(ss.data.study_list):
-
-        if i % 100 == 0:
-            print('Processing %d of %d' % (i, total))
-
-        path = os.path.join(ss.data_dir, 'Sleep_Data', name + '.tsv')
-        df = pd.read_csv(path, sep='\t')
-
-        if check_annotations(df) == False:
-            broken.append(name)
-
-    print('Processd %d files' % i)
+    print('Processd %d files' % total)
     print('%d files have no labeled sleeping stage' % len(broken))
 
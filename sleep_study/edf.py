@@ -0,0 +1,249 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import sleep_study as ss
+
+# Reads only the fixed-size EDF header: 256 bytes, then 256 bytes per signal
+# stored field by field (all labels, then all transducers, ...).
+
+HEADER_FIELDS = [
+        ('version', 8),
+        ('patient', 80),
+        ('recording', 80),
+        ('start_date', 8),
+        ('start_time', 8),
+        ('header_bytes', 8),
+        ('reserved', 44),
+        ('n_records', 8),
+        ('record_duration', 8),
+        ('n_signals', 4),
+        ]
+
+SIGNAL_FIELDS = [
+        ('labels', 16),
+        ('transducers', 80),
+        ('units', 8),
+        ('physical_min', 8),
+        ('physical_max', 8),
+        ('digital_min', 8),
+        ('digital_max', 8),
+        ('prefilters', 80),
+        ('n_samples', 8),
+        ('reserved', 32),
+        ]
+
+ANNOTATION_LABEL = 'EDF Annotations'
+
+inventory = None # Loaded on first use by get_inventory().
+
+
+def edf_path(name):
+    return os.path.join(ss.data_dir, 'Sleep_Data', name + '.edf')
+
+
+def edf_stamp(name):
+    st = os.stat(edf_path(name))
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _parse_start(date, time):
+    try:
+        day, month, year = [int(x) for x in date.split('.')]
+        hour, minute, second = [int(x) for x in time.split('.')]
+    except ValueError:
+        return None
+
+    # EDF years are two digits, 85-99 mean 19xx.
+    year += 1900 if year >= 85 else 2000
+    return datetime(year, month, day, hour, minute, second)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(256)
+
+        header = {}
+        pos = 0
+        for key, width in HEADER_FIELDS:
+            header[key] = raw[pos:pos + width].decode('latin-1').strip()
+            pos += width
+
+        n = int(header['n_signals'])
+        raw = f.read(256 * n)
+
+    pos = 0
+    for key, width in SIGNAL_FIELDS:
+        header[key] = [raw[pos + i * width:pos + (i + 1) * width].decode('latin-1').strip() for i in range(n)]
+        pos += n * width
+
+    for key in ['header_bytes', 'n_records', 'n_signals']:
+        header[key] = int(header[key])
+    header['record_duration'] = float(header['record_duration'])
+
+    for key in ['physical_min', 'physical_max', 'digital_min', 'digital_max']:
+        header[key] = np.array(header[key], dtype=np.float64)
+    header['n_samples'] = np.array(header['n_samples'], dtype=np.int64)
+
+    header['sfreq'] = header['n_samples'] / header['record_duration']
+    header['duration'] = header['n_records'] * header['record_duration']
+    header['start'] = _parse_start(header['start_date'], header['start_time'])
+
+    return header
+
+
+def read_channel_names(name):
+    # Upper case and without the annotation signal, like load_study.
+    header = read_header(edf_path(name))
+    return [x.upper() for x in header['labels'] if x != ANNOTATION_LABEL]
+
+
+class Inventory:
+
+    def __init__(self, studies, channels, stamps):
+        # studies has one row per study, channels one row per (study, channel).
+        self.studies = studies
+        self.channels = channels
+        self.stamps = stamps
+
+    def channel_names(self, name):
+        return self.channels.channel[self.channels.study == name].tolist()
+
+    def has_channels(self, channels, studies=None):
+        # Studies having all of the given channels.
+        channels = set(x.upper() for x in channels)
+
+        df = self.channels[self.channels.channel.isin(channels)]
+        counts = df.groupby('study', observed=True).channel.nunique()
+        res = counts.index[counts == len(channels)]
+
+        if studies is not None:
+            res = res[res.isin(studies)]
+        return res.tolist()
+
+    def channel_counts(self):
+        return self.channels.channel.value_counts()
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+
+        for key in ['studies', 'channels']:
+            tmp_path = os.path.join(path, key + '.pkl.tmp')
+            getattr(self, key).to_pickle(tmp_path)
+            os.replace(tmp_path, os.path.join(path, key + '.pkl'))
+
+        tmp_path = os.path.join(path, 'stamps.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.stamps, f)
+        os.replace(tmp_path, os.path.join(path, 'stamps.json'))
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'stamps.json')) as f:
+            stamps = json.load(f)
+
+        return cls(pd.read_pickle(os.path.join(path, 'studies.pkl')),
+                   pd.read_pickle(os.path.join(path, 'channels.pkl')),
+                   stamps)
+
+
+def _scan(name):
+    try:
+        return name, edf_stamp(name), read_header(edf_path(name)), None
+    except Exception as e:
+        return name, None, None, repr(e)
+
+
+def inventory_path():
+    if ss.cache_dir is None:
+        return None
+    return os.path.join(ss.cache_dir, 'inventory')
+
+
+def build_inventory(studies=None, old=None, n_workers=16, verbose=True):
+    if studies is None:
+        studies = ss.data.study_list
+    studies = sorted(studies)
+
+    stamps = {name: edf_stamp(name) for name in studies}
+    if old is not None and old.stamps == stamps:
+        return old
+
+    old_stamps = {} if old is None else old.stamps
+    todo = [name for name in studies if old_stamps.get(name) != stamps[name]]
+
+    if verbose:
+        print('Reading %d of %d EDF headers' % (len(todo), len(studies)))
+
+    # Header reads are small and I/O bound, threads are enough.
+    with ThreadPool(n_workers) as pool:
+        results = pool.map(_scan, todo)
+
+    study_rows = []
+    channel_rows = []
+    for name, stamp, header, error in results:
+        if error is not None:
+            print('Failed to read %s: %s' % (name, error))
+            stamps.pop(name)
+            continue
+
+        keep = [i for i, x in enumerate(header['labels']) if x != ANNOTATION_LABEL]
+        sfreq = header['sfreq'][keep]
+
+        study_rows.append({
+            'study': name,
+            'n_channels': len(keep),
+            'sfreq': sfreq.max() if len(keep) > 0 else np.nan,
+            'duration': header['duration'],
+            'start': header['start'],
+            })
+
+        for i in keep:
+            channel_rows.append({
+                'study': name,
+                'channel': header['labels'][i].upper(),
+                'label': header['labels'][i],
+                'sfreq': header['sfreq'][i],
+                'unit': header['units'][i],
+                })
+
+    study_df = pd.DataFrame(study_rows, columns=['study', 'n_channels', 'sfreq', 'duration', 'start'])
+    channel_df = pd.DataFrame(channel_rows, columns=['study', 'channel', 'label', 'sfreq', 'unit'])
+
+    # Keep the rows of unchanged studies.
+    if old is not None:
+        keep = set(studies) - set(todo)
+        study_df = pd.concat([old.studies[old.studies.study.isin(keep)], study_df])
+        channel_df = pd.concat([old.channels[old.channels.study.isin(keep)], channel_df])
+
+    study_df = study_df.sort_values('study').reset_index(drop=True)
+    channel_df = channel_df.sort_values('study', kind='stable').reset_index(drop=True)
+
+    for key in ['study', 'channel', 'unit']:
+        channel_df[key] = channel_df[key].astype('category')
+
+    return Inventory(study_df, channel_df, stamps)
+
+
+def get_inventory(refresh=False, n_workers=16, verbose=False):
+    # The inventory is checked against the .edf files once per process, or
+    # again when refresh is True.
+    global inventory
+
+    if inventory is not None and not refresh:
+        return inventory
+
+    path = inventory_path()
+    old = inventory
+    if old is None and path is not None and os.path.exists(os.path.join(path, 'stamps.json')):
+        old = Inventory.load(path)
+
+    new = build_inventory(ss.data.study_list, old, n_workers, verbose)
+    if new is not old and path is not None:
+        new.save(path)
+
+    inventory = new
+    return inventory
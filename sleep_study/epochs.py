@@ -0,0 +1,122 @@
+import numpy as np
+
+# Epochs kept as 16 bit digital values, like in the EDF file, with a gain
+# and offset per channel:
+#
+#   physical = digital * gain + offset
+#
+# A quarter of the memory of the float64 mne returns. Values are converted
+# to float32 only when read, chunk by chunk: np.asarray(epochs[i:j]) or
+# epochs.to_float(). The gain and offset of a study come from the physical
+# and digital ranges in its EDF header, in volts like mne. A derived channel
+# (see ss.montage) gets the range of its terms summed, so it never clips.
+# Resampled values are rounded to the digital grid of the recording.
+
+DIGITAL_MIN = -32768
+DIGITAL_MAX = 32767
+
+# Physical dimensions and their factor to the units of mne, others are kept as is.
+UNITS = {'V': 1., 'MV': 1e-3, 'UV': 1e-6, 'NV': 1e-9}
+
+
+def header_scaling(header, labels):
+    # Gain and offset of the channels labels (any case) of an EDF header,
+    # see ss.edf.read_header.
+    names = [x.upper() for x in header['labels']]
+    idx = [names.index(x.upper()) for x in labels]
+
+    pmin, pmax = header['physical_min'][idx], header['physical_max'][idx]
+    dmin, dmax = header['digital_min'][idx], header['digital_max'][idx]
+
+    gain = np.where(dmax > dmin, (pmax - pmin) / np.where(dmax > dmin, dmax - dmin, 1), 1.)
+    offset = pmin - dmin * gain
+
+    units = np.array([UNITS.get(header['units'][i].replace('\xb5', 'u').upper(), 1.) for i in idx])
+    return gain * units, offset * units
+
+
+def derived_scaling(gain, offset, weights):
+    # Of the channels weights @ sources, for sources of gain and offset.
+    return np.abs(weights) @ gain, weights @ offset
+
+
+def range_scaling(data):
+    # Gain and offset covering the range of every channel of float data.
+    low = data.min(axis=(0, 2)).astype(np.float64) if len(data) > 0 else np.zeros(data.shape[1])
+    high = data.max(axis=(0, 2)).astype(np.float64) if len(data) > 0 else np.zeros(data.shape[1])
+
+    gain = (high - low) / (DIGITAL_MAX - DIGITAL_MIN)
+    gain[gain == 0] = 1.
+    offset = low - DIGITAL_MIN * gain
+    return gain, offset
+
+
+class Epochs:
+
+    def __init__(self, digital, gain, offset):
+        # digital is (num epochs) by (num channels) by (num samples) int16,
+        # gain and offset are (num channels).
+        self.digital = digital
+        self.gain = np.asarray(gain, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+
+    @classmethod
+    def quantize(cls, data, gain=None, offset=None, chunk_size=256):
+        # From float data, by default over the range of every channel.
+        if gain is None:
+            gain, offset = range_scaling(data)
+
+        g = np.asarray(gain)[:, np.newaxis]
+        o = np.asarray(offset)[:, np.newaxis]
+
+        digital = np.empty(data.shape, dtype=np.int16)
+        for i in range(0, len(data), chunk_size):
+            x = (data[i:i + chunk_size] - o) / g
+            np.clip(np.rint(x, out=x), DIGITAL_MIN, DIGITAL_MAX, out=x)
+            digital[i:i + chunk_size] = x
+
+        return cls(digital, gain, offset)
+
+    @property
+    def shape(self):
+        return self.digital.shape
+
+    @property
+    def ndim(self):
+        return self.digital.ndim
+
+    @property
+    def nbytes(self):
+        return self.digital.nbytes
+
+    dtype = np.dtype(np.float32) # Of the converted values.
+
+    def __len__(self):
+        return len(self.digital)
+
+    def __getitem__(self, idx):
+        # Epochs of the selected epochs and channels, still digital. An index
+        # dropping an axis, e.g. a single epoch, is converted.
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        if any(x is None or x is Ellipsis for x in idx):
+            raise IndexError('None and ... are not supported in Epochs indices')
+
+        digital = self.digital[idx]
+        if digital.ndim == 3:
+            channels = idx[1] if len(idx) > 1 else slice(None)
+            return Epochs(digital, self.gain[channels], self.offset[channels])
+
+        # The scaling is selected by the same index, as a broadcast view.
+        shape = self.digital.shape
+        gain = np.broadcast_to(self.gain.astype(np.float32)[:, np.newaxis], shape)[idx]
+        offset = np.broadcast_to(self.offset.astype(np.float32)[:, np.newaxis], shape)[idx]
+        return digital * gain + offset
+
+    def to_float(self, dtype=np.float32, out=None):
+        gain = self.gain[:, np.newaxis].astype(dtype)
+        out = np.multiply(self.digital, gain, out=out, dtype=dtype)
+        out += self.offset[:, np.newaxis].astype(dtype)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_float(np.float32 if dtype is None else dtype)
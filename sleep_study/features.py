@@ -0,0 +1,150 @@
+import functools
+import numpy as np
+import pandas as pd
+
+import sleep_study as ss
+
+# Statistics of the wavelet coefficients of each level, all derived from the
+# same running sums so every coefficient array is only reduced once per sum.
+WAVELET_STATS = ['mean', 'std', 'min', 'max']
+ALL_WAVELET_STATS = WAVELET_STATS + ['rms', 'abs_mean']
+
+
+def feature_names(level=2, stats=WAVELET_STATS, bands=ss.info.FREQ_BANDS):
+    # pywt.wavedec returns the approximation of the last level first, then
+    # the details from the last level down to the first.
+    levels = ['a%d' % level] + ['d%d' % i for i in range(level, 0, -1)]
+
+    names = ['%s_%s' % (x, stat) for x in levels for stat in stats]
+    names += ['power_%g-%gHz' % (low, high) for low, high in bands]
+    return names
+
+
+def _wavelet_stats(x, stats, out):
+    # x is (num epochs) by (num channels) by (num coefficients)
+    n = x.shape[-1]
+    need = set(stats)
+
+    if need & {'mean', 'std'}:
+        mean = x.sum(-1) / n
+    if need & {'std', 'rms'}:
+        mean_sq = np.einsum('ijk,ijk->ij', x, x) / n
+
+    for i, stat in enumerate(stats):
+        if stat == 'mean':
+            out[..., i] = mean
+        elif stat == 'std':
+            out[..., i] = np.sqrt(np.maximum(mean_sq - mean**2, 0))
+        elif stat == 'min':
+            x.min(-1, out=out[..., i])
+        elif stat == 'max':
+            x.max(-1, out=out[..., i])
+        elif stat == 'rms':
+            out[..., i] = np.sqrt(mean_sq)
+        elif stat == 'abs_mean':
+            out[..., i] = np.abs(x).sum(-1) / n
+        else:
+            raise ValueError('unknown statistic %s' % stat)
+
+
+def _band_powers(x, sfreq, bands, out):
+    # Welch PSD of all epochs and channels at once, 2 s segments (or the whole
+    # epoch if shorter).
+    from scipy import signal
+
+    nperseg = min(x.shape[-1], 2 * int(sfreq))
+    f, psd = signal.welch(x, fs=sfreq, nperseg=nperseg, axis=-1)
+    df = f[1] - f[0]
+
+    for i, (low, high) in enumerate(bands):
+        # Bands above the Nyquist frequency are cut off, empty ones are 0.
+        mask = (f >= low) & (f < high)
+        out[..., i] = psd[..., mask].sum(-1) * df
+
+
+def get_features(data, sfreq=ss.info.REFERENCE_FREQ, n=4, level=2, stats=WAVELET_STATS,
+                 bands=ss.info.FREQ_BANDS, chunk_size=512, out=None):
+    # data is (num epochs) by (num channels) by (num samples). Features are
+    # computed chunk_size epochs at a time and written into out, which is
+    # (num epochs) by (num channels) by (num features), in the order of
+    # feature_names(level, stats, bands).
+    import pywt
+
+    names = feature_names(level, stats, bands)
+    n_stats = len(stats) * (level + 1)
+
+    if out is None:
+        out = np.empty(data.shape[:2] + (len(names),))
+
+    wavelet = pywt.Wavelet('db%d' % n)
+
+    with ss.profiling.timer('features') as t:
+        for start in range(0, len(data), chunk_size):
+            x = np.asarray(data[start:start + chunk_size])
+            res = out[start:start + chunk_size]
+
+            if len(stats) > 0:
+                coeffs = pywt.wavedec(x, wavelet, level=level, axis=-1)
+                for i, c in enumerate(coeffs):
+                    _wavelet_stats(c, stats, res[..., i * len(stats):(i + 1) * len(stats)])
+
+            if len(bands) > 0:
+                _band_powers(x, sfreq, bands, res[..., n_stats:])
+
+        t.bytes = data.nbytes
+        t.epochs = len(data)
+
+    return out, names
+
+
+def to_frame(features, names, channels):
+    # Flattens (num epochs) by (num channels) by (num features) into one row
+    # per epoch with a '<channel> <feature>' column per channel and feature.
+    columns = ['%s %s' % (ch, name) for ch in channels for name in names]
+    return pd.DataFrame(features.reshape(len(features), -1), columns=columns)
+
+
+def _read_batches(name, channels, batch_size):
+    return list(ss.data.iter_sleep_eeg_and_stages(name, channels, batch_size))
+
+
+def get_feature_table(studies, channels=ss.info.EEG_CH_NAMES, batch_size=256, n_prefetch=0, memory_limit=None,
+                      **kwargs):
+    # One row per epoch of every study, built from the streaming epoch
+    # generator so no study is held in memory as a whole. With n_prefetch,
+    # the next studies are read whole in the background instead, see
+    # ss.prefetch, and studies which fail to load are reported and skipped.
+    if n_prefetch > 0:
+        load = functools.partial(_read_batches, channels=channels, batch_size=batch_size)
+        source = ss.prefetch.iter_studies(load, studies, n_prefetch, memory_limit)
+    else:
+        source = ((name, ss.data.iter_sleep_eeg_and_stages(name, channels, batch_size), None) for name in studies)
+
+    frames = []
+
+    for i, (name, batches, error) in enumerate(source):
+
+        if (i + 1) % 100 == 0:
+            print('Processed %d of %d' % (i + 1, len(studies)))
+
+        if error is not None:
+            print('Failed %s:\n%s' % (name, error))
+            continue
+
+        offset = 0
+        with ss.profiling.study(name):
+            for data, labels in batches:
+                features, names = get_features(data, **kwargs)
+
+                df = to_frame(features, names, channels)
+                df.insert(0, 'label', labels)
+                df.insert(0, 'epoch', np.arange(offset, offset + len(labels)))
+                df.insert(0, 'study', name)
+                frames.append(df)
+
+                offset += len(labels)
+
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(frames, ignore_index=True)
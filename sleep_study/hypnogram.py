@@ -0,0 +1,199 @@
+import numpy as np
+import pandas as pd
+
+import sleep_study as ss
+
+# Hypnograms of every study, one int8 code per 30 s epoch as in
+# info.EVENT_DICT and UNSCORED for epochs without a sleep stage annotation,
+# concatenated into one array like the annotation store:
+#
+#   stages   int8 codes of all studies, study after study
+#   offsets  where every study starts in stages, and the end
+#
+# Epochs are placed by onset from the first sleep stage annotation of the
+# study, annotations longer than one epoch cover several. Sleep architecture
+# metrics are computed for all studies at once from runs of equal stages:
+#
+#   TIB_MIN                time in bed, first to last scored epoch
+#   TST_MIN                total sleep time, stages N1, N2, N3 and R
+#   SE                     sleep efficiency, TST / TIB
+#   SOL_MIN                sleep onset latency, to the first sleep epoch
+#   REM_LATENCY_MIN        first R epoch after sleep onset
+#   WASO_MIN               wake after sleep onset, before the last sleep epoch
+#   N_AWAKENINGS           wake bouts after sleep onset, before the last sleep epoch
+#   N_TRANSITIONS          changes between scored stages
+#   <stage>_MIN            time in every stage
+#   <stage>_BOUTS          number of bouts of every stage
+#   <stage>_MEAN_BOUT_MIN  mean bout length of every stage
+#   <stage>_MAX_BOUT_MIN   longest bout of every stage
+#
+# Latencies are NaN for studies that never reach the stage.
+
+UNSCORED = -1
+
+WAKE = ss.info.EVENT_DICT['Sleep stage W']
+SLEEP = [ss.info.EVENT_DICT[x] for x in ['Sleep stage N1', 'Sleep stage N2', 'Sleep stage N3', 'Sleep stage R']]
+REM = ss.info.EVENT_DICT['Sleep stage R']
+
+hypnograms = None # Built on first use by get_hypnograms().
+
+
+class Hypnograms:
+
+    def __init__(self, studies, stamps, stages, offsets):
+        self.studies = list(studies)
+        self.stamps = stamps
+        self.stages = stages
+        self.offsets = offsets
+        self.study_ids = {name: i for i, name in enumerate(self.studies)}
+
+    def __len__(self):
+        return len(self.studies)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def get(self, name):
+        i = self.study_ids[name]
+        return self.stages[self.offsets[i]:self.offsets[i + 1]]
+
+
+def build_hypnograms(store=None):
+    s = ss.annotations.get_store() if store is None else store
+
+    # Stage code of every description, UNSCORED for other annotations.
+    lookup = np.full(len(s.descriptions) + 1, UNSCORED, dtype=np.int8)
+    for stage, code in ss.info.EVENT_DICT.items():
+        lookup[s.description_codes([stage])] = code
+
+    rows = np.flatnonzero(lookup[s.description] != UNSCORED)
+    rows = rows[np.lexsort((s.onset[rows], s.study[rows]))]
+
+    study = s.study[rows].astype(np.int64)
+    onset = s.onset[rows]
+    stage = lookup[s.description[rows]]
+
+    # Onset of the first stage annotation of every study.
+    first = np.zeros(len(s.studies))
+    ids, idx = np.unique(study, return_index=True)
+    first[ids] = onset[idx]
+
+    epoch = np.rint((onset - first[study]) / ss.info.INTERVAL).astype(np.int64)
+    n = np.maximum(np.rint(s.duration[rows] / ss.info.INTERVAL).astype(np.int64), 1)
+
+    # One entry per covered epoch.
+    starts = np.cumsum(n) - n
+    study = np.repeat(study, n)
+    stage = np.repeat(stage, n)
+    epoch = np.repeat(epoch, n) + np.arange(n.sum()) - np.repeat(starts, n)
+
+    lengths = np.zeros(len(s.studies), dtype=np.int64)
+    np.maximum.at(lengths, study, epoch + 1)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    stages = np.full(offsets[-1], UNSCORED, dtype=np.int8)
+    stages[offsets[study] + epoch] = stage
+
+    return Hypnograms(s.studies, s.stamps, stages, offsets)
+
+
+def get_hypnograms(refresh=False):
+    # Built again whenever the annotation store changed.
+    global hypnograms
+
+    s = ss.annotations.get_store(refresh=refresh)
+    if hypnograms is None or hypnograms.stamps != s.stamps:
+        hypnograms = build_hypnograms(s)
+    return hypnograms
+
+
+def get_hypnogram(name):
+    return get_hypnograms().get(name)
+
+
+def _first(mask, study, pos, n):
+    # Position of the first True epoch of every study, -1 if none.
+    res = np.full(n, -1, dtype=np.int64)
+    idx = np.flatnonzero(mask)
+    ids, first = np.unique(study[idx], return_index=True)
+    res[ids] = pos[idx[first]]
+    return res
+
+
+def _last(mask, study, pos, n):
+    res = np.full(n, -1, dtype=np.int64)
+    np.maximum.at(res, study[mask], pos[mask])
+    return res
+
+
+def compute_metrics(h=None):
+    if h is None:
+        h = get_hypnograms()
+
+    n = len(h)
+    k = len(ss.info.EVENT_DICT)
+    minutes = ss.info.INTERVAL / 60
+    lengths = h.lengths()
+
+    stages = h.stages
+    study = np.repeat(np.arange(n), lengths)
+    pos = np.arange(len(stages)) - h.offsets[study]
+
+    scored = stages != UNSCORED
+    sleep = np.isin(stages, SLEEP)
+
+    onset = _first(sleep, study, pos, n)
+    end = _last(sleep, study, pos, n)
+    rem = _first(stages == REM, study, pos, n)
+
+    start = _first(scored, study, pos, n)
+    stop = _last(scored, study, pos, n)
+
+    df = pd.DataFrame(index=pd.Index(h.studies, name='STUDY'))
+    df['TIB_MIN'] = np.where(start >= 0, stop - start + 1, 0) * minutes
+    df['TST_MIN'] = np.bincount(study[sleep], minlength=n) * minutes
+    df['SE'] = df.TST_MIN / df.TIB_MIN.where(df.TIB_MIN > 0)
+    df['SOL_MIN'] = np.where(onset >= 0, (onset - start) * minutes, np.nan)
+    df['REM_LATENCY_MIN'] = np.where(rem >= 0, (rem - onset) * minutes, np.nan)
+
+    after_onset = (pos > onset[study]) & (pos < end[study]) & (onset[study] >= 0)
+    df['WASO_MIN'] = np.bincount(study[after_onset & (stages == WAKE)], minlength=n) * minutes
+
+    # Runs of equal stages within a study.
+    new = np.ones(len(stages), dtype=bool)
+    new[1:] = (stages[1:] != stages[:-1]) | (study[1:] != study[:-1])
+    run_starts = np.flatnonzero(new)
+    run_lengths = np.diff(np.append(run_starts, len(stages)))
+    run_stage = stages[run_starts]
+    run_study = study[run_starts]
+
+    awakening = (run_stage == WAKE) & after_onset[run_starts]
+    df['N_AWAKENINGS'] = np.bincount(run_study[awakening], minlength=n)
+
+    # Unscored epochs break a transition, e.g. N2, unscored, N3 is none.
+    transition = (run_study[1:] == run_study[:-1]) & (run_stage[1:] != UNSCORED) & (run_stage[:-1] != UNSCORED)
+    df['N_TRANSITIONS'] = np.bincount(run_study[1:][transition], minlength=n)
+
+    valid = run_stage != UNSCORED
+    key = run_study[valid] * k + run_stage[valid]
+    bouts = np.bincount(key, minlength=n * k).reshape(n, k)
+    total = np.bincount(key, weights=run_lengths[valid], minlength=n * k).reshape(n, k)
+    longest = np.zeros(n * k, dtype=np.int64)
+    np.maximum.at(longest, key, run_lengths[valid])
+    longest = longest.reshape(n, k)
+
+    for stage, code in ss.info.EVENT_DICT.items():
+        name = stage.split()[-1]
+        df[name + '_MIN'] = total[:, code] * minutes
+        df[name + '_BOUTS'] = bouts[:, code]
+        df[name + '_MEAN_BOUT_MIN'] = total[:, code] / np.where(bouts[:, code] > 0, bouts[:, code], np.nan) * minutes
+        df[name + '_MAX_BOUT_MIN'] = longest[:, code] * minutes
+
+    return df
+
+
+def get_metrics(studies=None, refresh=False):
+    df = compute_metrics(get_hypnograms(refresh))
+    if studies is not None:
+        df = df.loc[list(studies)]
+    return df
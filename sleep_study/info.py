@@ -1,4 +1,6 @@
 import os
+import hashlib
+import numpy as np
 import pandas as pd
 
 import sleep_study as ss
@@ -78,46 +80,153 @@ HEALTH_DATA_FNS = [DEMOGRAPHIC,
                    PROCEDURE, 
                    SLEEP_ENC_ID, 
                    SLEEP_STUDY_NAME]
+SLEEP_STUDY_DATES = None # (patient id, study id) -> study date, built by ss.init().
+
 INTERVAL = 30 # seconds.
 REFERENCE_FREQ = 128 # Hz. 80% of the studies have sampling frequency of 256 HZ.
 
-def load_health_info(name, convert_datetime=True):
-    assert type(name) == str
-        
+# Columns parsed as datetimes by load_health_info.
+HEALTH_DATA_DATES = {
+        DEMOGRAPHIC: ['BIRTH_DATE'],
+        DIAGNOSIS: ['DX_START_DATETIME', 'DX_END_DATETIME'],
+        ENCOUNTER: ['ENCOUNTER_DATE', 'VISIT_START_DATETIME', 'VISIT_END_DATETIME',
+                    'ADT_ARRIVAL_DATETIME', 'ED_DEPARTURE_DATETIME'],
+        MEASUREMENT: ['MEAS_RECORDED_DATETIME'],
+        MEDICATION: ['MED_START_DATETIME', 'MED_END_DATETIME', 'MED_ORDER_DATETIME', 'MED_TAKEN_DATETIME'],
+        PROCEDURE: ['PROCEDURE_DATETIME'],
+        PROCEDURE_SURG_HX: ['PROC_NOTED_DATE', 'PROC_START_TIME', 'PROC_END_TIME'],
+        SLEEP_STUDY_NAME: ['SLEEP_STUDY_START_DATETIME'],
+        }
+
+# Patient and study ids are small, other ids may be missing or large.
+HEALTH_DATA_ID_DTYPES = {
+        'STUDY_PAT_ID': 'int32',
+        'SLEEP_STUDY_ID': 'int32',
+        }
+
+# Repetitive text columns are stored as categoricals.
+HEALTH_DATA_CATEGORY_SUFFIXES = ('_DESCR', '_CD', '_NAME', '_TYPE', '_CODE', '_UNIT', '_SOURCE', '_ROUTE')
+
+_health_cache = {} # (name, convert_datetime, columns or None) -> DataFrame, per process.
+
+def get_health_dtypes(name, columns):
+    dtypes = {}
+    for column in columns:
+        if column in HEALTH_DATA_ID_DTYPES:
+            dtypes[column] = HEALTH_DATA_ID_DTYPES[column]
+        elif column.endswith('_ID'):
+            dtypes[column] = 'Int64'
+        elif column.endswith(HEALTH_DATA_CATEGORY_SUFFIXES) and column not in HEALTH_DATA_DATES.get(name, []):
+            dtypes[column] = 'category'
+    return dtypes
+
+def _read_health_csv(name, convert_datetime, usecols=None, chunksize=None):
     path = os.path.join(ss.data_dir, 'Health_Data', name)
-    df = pd.read_csv(path)
-    
-    if convert_datetime:
-        if name == DEMOGRAPHIC:
-            df['BIRTH_DATE'] = pd.to_datetime(df['BIRTH_DATE'], infer_datetime_format=True)
-        elif name == DIAGNOSIS:
-            df['DX_START_DATETIME'] = pd.to_datetime(df['DX_START_DATETIME'], infer_datetime_format=True)
-            df['DX_END_DATETIME'] = pd.to_datetime(df['DX_END_DATETIME'], infer_datetime_format=True)
-        elif name == ENCOUNTER:
-            df['ENCOUNTER_DATE'] = pd.to_datetime(df['ENCOUNTER_DATE'], infer_datetime_format=True)
-            df['VISIT_START_DATETIME'] = pd.to_datetime(df['VISIT_START_DATETIME'], infer_datetime_format=True)
-            df['VISIT_END_DATETIME'] = pd.to_datetime(df['VISIT_END_DATETIME'], infer_datetime_format=True)
-            df['ADT_ARRIVAL_DATETIME'] = pd.to_datetime(df['ADT_ARRIVAL_DATETIME'], infer_datetime_format=True)
-            df['ED_DEPARTURE_DATETIME'] = pd.to_datetime(df['ED_DEPARTURE_DATETIME'], infer_datetime_format=True)
-        elif name == MEASUREMENT:
-            df['MEAS_RECORDED_DATETIME'] = pd.to_datetime(df['MEAS_RECORDED_DATETIME'], infer_datetime_format=True)
-        elif name == MEDICATION:
-            df['MED_START_DATETIME'] = pd.to_datetime(df['MED_START_DATETIME'], infer_datetime_format=True)
-            df['MED_END_DATETIME'] = pd.to_datetime(df['MED_END_DATETIME'], infer_datetime_format=True)
-            df['MED_ORDER_DATETIME'] = pd.to_datetime(df['MED_ORDER_DATETIME'], infer_datetime_format=True)
-            df['MED_TAKEN_DATETIME'] = pd.to_datetime(df['MED_TAKEN_DATETIME'], infer_datetime_format=True)
-        elif name == PROCEDURE:
-            df['PROCEDURE_DATETIME'] = pd.to_datetime(df['PROCEDURE_DATETIME'], infer_datetime_format=True)
-        elif name == PROCEDURE_SURG_HX:
-            df['PROC_NOTED_DATE'] = pd.to_datetime(df['PROC_NOTED_DATE'], infer_datetime_format=True)
-            df['PROC_START_TIME'] = pd.to_datetime(df['PROC_START_TIME'], infer_datetime_format=True)
-            df['PROC_END_TIME'] = pd.to_datetime(df['PROC_END_TIME'], infer_datetime_format=True)
-        elif name == SLEEP_STUDY_NAME:
-            df['SLEEP_STUDY_START_DATETIME'] = pd.to_datetime(df['SLEEP_STUDY_START_DATETIME'])
+
+    columns = pd.read_csv(path, nrows=0).columns
+    if usecols is not None:
+        columns = [x for x in columns if x in usecols]
+
+    kwargs = {'usecols': usecols, 'dtype': get_health_dtypes(name, columns)}
+
+    def convert(df):
+        if convert_datetime:
+            for column in HEALTH_DATA_DATES.get(name, []):
+                if column in df:
+                    df[column] = pd.to_datetime(df[column], cache=True)
+        return df
+
+    if chunksize is not None:
+        return (convert(df) for df in pd.read_csv(path, chunksize=chunksize, **kwargs))
+
+    return convert(pd.read_csv(path, **kwargs))
+
+def _health_cache_path(name, convert_datetime, columns=None):
+    if ss.cache_dir is None:
+        return None
+
+    fn = '%s.%d' % (name[:-4], convert_datetime)
+    if columns is not None:
+        fn += '.' + hashlib.sha1(' '.join(columns).encode()).hexdigest()[:16]
+    return os.path.join(ss.cache_dir, 'health', fn)
+
+def load_health_info(name, convert_datetime=True, usecols=None, chunksize=None):
+    # Tables are read once per process and, with a cache directory, stored
+    # as a pickled frame next to the mtime/size of the csv it came from.
+    # usecols projects columns, only those are parsed and cached, unless the
+    # whole table is loaded already. chunksize returns an iterator of typed
+    # chunks read straight from the csv, for tables too large to hold at once.
+    assert type(name) == str
+
+    if chunksize is not None:
+        return _read_health_csv(name, convert_datetime, usecols, chunksize)
+
+    columns = None if usecols is None else tuple(sorted(usecols))
+    full = (name, convert_datetime, None)
+
+    if columns is not None and full in _health_cache:
+        df = _health_cache[full]
+        df = df[[x for x in df.columns if x in usecols]]
+    else:
+        key = (name, convert_datetime, columns)
+        if key not in _health_cache:
+            _health_cache[key] = _load_cached_health_info(name, convert_datetime, columns)
+        df = _health_cache[key]
+
+    return df.copy(deep=False)
+
+def _load_cached_health_info(name, convert_datetime, columns=None):
+    usecols = None if columns is None else list(columns)
+
+    path = _health_cache_path(name, convert_datetime, columns)
+    if path is None:
+        return _read_health_csv(name, convert_datetime, usecols)
+
+    st = os.stat(os.path.join(ss.data_dir, 'Health_Data', name))
+    stamp = '%d %d' % (st.st_mtime_ns, st.st_size)
+
+    try:
+        with open(path + '.stamp') as f:
+            if f.read() == stamp:
+                return pd.read_pickle(path + '.pkl')
+    except OSError:
+        pass
+
+    df = _read_health_csv(name, convert_datetime, usecols)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_pickle(path + '.pkl.tmp')
+    os.replace(path + '.pkl.tmp', path + '.pkl')
+    with open(path + '.stamp', 'w') as f:
+        f.write(stamp)
 
     return df
 
 
+class HealthData:
+    # Health_Data tables as attributes, e.g. ss.info.health.DEMOGRAPHIC, each
+    # loaded on first access.
+
+    TABLES = {x[:-4]: x for x in HEALTH_DATA_FNS}
+
+    def __getattr__(self, table):
+        if table not in self.TABLES:
+            raise AttributeError(table)
+
+        df = load_health_info(self.TABLES[table])
+        setattr(self, table, df)
+        return df
+
+    def __dir__(self):
+        return list(self.TABLES)
+
+health = HealthData()
+
+def build_sleep_study_dates(df):
+    dates = pd.to_datetime(df.SLEEP_STUDY_START_DATETIME).dt.date
+    return dict(zip(zip(df.STUDY_PAT_ID.astype(int), df.SLEEP_STUDY_ID.astype(int)), dates))
+
+
 def hist(l, h={}):
     for k in l:
         try:
@@ -133,40 +242,26 @@ def normalize(h):
     return h
 
 def patient_cohort():
-    global DEMOGRAPHIC
-    DEMOGRAPHIC = load_health_info(DEMOGRAPHIC)
-
-    N = len(DEMOGRAPHIC)
-
-    DEMOGRAPHIC = a
+    demographic = health.DEMOGRAPHIC
 
-    race_hist = hist(DEMOGRAPHIC.RACE_DESCR.values)
+    race_hist = hist(demographic.RACE_DESCR.values, {})
 
     for race in list(race_hist.keys()):
         if race != 'Unknown' and race_hist[race] <= 10:
-            race_hist['Unknown'] += race_hist[race]
+            race_hist['Unknown'] = race_hist.get('Unknown', 0) + race_hist[race]
             del race_hist[race]
 
     normalize(race_hist)
 
-    gender_hist = hist(DEMOGRAPHIC.GENDER_DESCR.values)
+    gender_hist = hist(demographic.GENDER_DESCR.values, {})
     normalize(gender_hist)
 
+    # Years between the first and the last encounter of each patient.
+    encounter = load_health_info(ENCOUNTER, usecols=['STUDY_PAT_ID', 'ENCOUNTER_DATE'])
+    b = encounter.groupby('STUDY_PAT_ID').ENCOUNTER_DATE
 
-    global ENCOUNTER
-    ENCOUNTER = load_health_info(ENCOUNTER)
-
-
-    a = ENCOUNTER[['STUDY_PAT_ID', 'VISIT_START_DATETIME', 'VISIT_END_DATETIME']]
-
-    a = ENCOUNTER[['STUDY_PAT_ID', 'ENCOUNTER_DATE']]
-    # df['DataFrame Column'] = pd.to_datetime(df['DataFrame Column'], format=specify your format)
-    a['ENCOUNTER_DATE'] = pd.to_datetime(a['ENCOUNTER_DATE'])
-    b = a.groupby('STUDY_PAT_ID')
-    b.groups.keys()
-
-    c = b.ENCOUNTER_DATE.max() - b.ENCOUNTER_DATE.min()
+    c = b.max() - b.min()
     c = c.values / np.timedelta64(1, 'D')
     c /= 365
 
-
+    return race_hist, gender_hist, c
@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+import sleep_study as ss
+
+# Resolves requested channels, e.g. 'EEG C4-M1', against the channels a study
+# actually has. Labels vary between studies in their type prefix ('EEG Chin1-
+# Chin2' or 'EMG Chin1-Chin2'), in electrode names ('M1' or 'A1') and in which
+# derivations were recorded. A channel resolves, in order of preference, to
+#
+#   the same label                     C4-M1 = C4-M1
+#   the same electrodes under aliases  C4-M1 = C4-A1
+#   the reversed derivation            C4-M1 = -(M1-C4)
+#   the shortest chain of derivations  C4-M1 = (C4-X) - (M1-X)
+#   connecting its electrodes                = (C4-X) + (X-Y) + (Y-M1) ...
+#
+# A plan lists, for every requested channel, the (source channel, weight)
+# terms summed to produce it, or None when it can not be resolved. Source
+# channels are upper case, like in load_study and the inventory.
+
+# Type prefixes, ignored when matching but preferred when equal.
+TYPES = ['EEG', 'EOG', 'EMG', 'ECG', 'EKG', 'RESP']
+
+# Alternative electrode names and their canonical name.
+ELECTRODE_ALIASES = {
+        'A1': 'M1',
+        'A2': 'M2',
+        'E1': 'LOC',
+        'E2': 'ROC',
+        'T3': 'T7',
+        'T4': 'T8',
+        'T5': 'P7',
+        'T6': 'P8',
+        }
+
+plans = {} # Resolved plans of every study by channels, filled by get_plans().
+
+
+def parse(label):
+    # 'EEG C4-A1' -> ('EEG', ('C4', 'M1')), 'SpO2' -> (None, ('SPO2',))
+    words = label.upper().split()
+    kind = None
+    if len(words) > 1 and words[0] in TYPES:
+        kind, words = words[0], words[1:]
+
+    electrodes = tuple(ELECTRODE_ALIASES.get(x.strip(), x.strip()) for x in ' '.join(words).split('-'))
+    return kind, electrodes
+
+
+def resolve(channel, labels):
+    # Terms of one channel given the channel names of a study, or None.
+    labels = [x.upper() for x in labels]
+    if channel.upper() in labels:
+        return [[channel.upper(), 1.]]
+
+    kind, electrodes = parse(channel)
+
+    # Derivations by electrodes, labels of the requested type first.
+    index = {}
+    for label in sorted(labels, key=lambda x: parse(x)[0] != kind):
+        index.setdefault(parse(label)[1], label)
+
+    if electrodes in index:
+        return [[index[electrodes], 1.]]
+
+    if len(electrodes) != 2:
+        return None
+
+    # Breadth first search for the shortest chain of derivations from a to
+    # b, e.g. a - b = (a - x) - (b - x) through a shared electrode x.
+    edges = {}
+    for key, label in index.items():
+        if len(key) == 2:
+            u, v = key
+            edges.setdefault(u, []).append((v, [label, 1.]))
+            edges.setdefault(v, []).append((u, [label, -1.]))
+
+    a, b = electrodes
+    paths = {a: []}
+    queue = [a]
+    for u in queue:
+        if u == b:
+            return paths[u]
+        for v, term in edges.get(u, []):
+            if v not in paths:
+                paths[v] = paths[u] + [term]
+                queue.append(v)
+
+    return None
+
+
+def resolve_all(channels, labels):
+    return [resolve(x, labels) for x in channels]
+
+
+def missing(plan, channels):
+    return [x for x, terms in zip(channels, plan) if terms is None]
+
+
+def plan_matrix(plan, channels=None):
+    # Source channels to read and the (num channels) by (num sources) weights
+    # mapping them to the requested channels.
+    if channels is not None and None in plan:
+        raise ValueError('missing channels: ' + ', '.join(missing(plan, channels)))
+
+    sources = list(dict.fromkeys(name for terms in plan for name, _ in terms))
+    weights = np.zeros((len(plan), len(sources)))
+    for i, terms in enumerate(plan):
+        for name, w in terms:
+            weights[i, sources.index(name)] += w
+
+    return sources, weights
+
+
+def apply_weights(data, weights):
+    # data is (num epochs) by (num sources) by (num samples).
+    if weights.shape[0] == weights.shape[1] and (weights == np.eye(len(weights))).all():
+        return data
+    return np.matmul(weights.astype(data.dtype), data)
+
+
+def plans_key(channels):
+    # The aliases and types are part of the key, so editing them resolves
+    # the plans again.
+    rules = [list(channels), ELECTRODE_ALIASES, TYPES]
+    return hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def plans_path(channels):
+    if ss.cache_dir is None:
+        return None
+
+    return os.path.join(ss.edf.inventory_path(), 'plans', plans_key(channels) + '.json')
+
+
+def get_plans(channels, refresh=False):
+    # Plans of every study in the inventory, kept in memory and next to the
+    # inventory on disk. Entries are reused while the EDF stamp of the study
+    # is unchanged.
+    key = plans_key(channels)
+    if key in plans and not refresh:
+        return plans[key]
+
+    inventory = ss.edf.get_inventory()
+    path = plans_path(channels)
+
+    old = {}
+    if path is not None and os.path.exists(path):
+        try:
+            with open(path) as f:
+                old = json.load(f)['plans']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    labels = inventory.channels.groupby('study', observed=True).channel.apply(list)
+
+    table = {}
+    changed = False
+    for name, stamp in inventory.stamps.items():
+        if name in old and old[name][0] == stamp:
+            table[name] = old[name][1]
+        else:
+            table[name] = resolve_all(channels, labels.get(name, []))
+            changed = True
+
+    if path is not None and (changed or len(old) != len(table)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'channels': list(channels),
+                       'plans': {name: [inventory.stamps[name], plan] for name, plan in table.items()}}, f)
+        os.replace(path + '.tmp', path)
+
+    plans[key] = table
+    return table
+
+
+def get_plan(name, channels):
+    # From the plans of get_plans() when loaded, otherwise resolved from the
+    # header of the study alone.
+    table = plans.get(plans_key(channels))
+    if table is not None and name in table:
+        return table[name]
+
+    return resolve_all(channels, ss.data.get_channel_names(name))
+
+
+def available(channels, studies=None):
+    # Studies where every channel resolves.
+    table = get_plans(channels)
+    res = [name for name, plan in table.items() if None not in plan]
+
+    if studies is not None:
+        studies = set(studies)
+        res = [x for x in res if x in studies]
+    return res
@@ -0,0 +1,123 @@
+import os
+import traceback
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import sleep_study as ss
+
+# Runs func(name) for the next studies on a pool while the caller works on
+# the current one, so reading and decoding EDF files overlaps with computing:
+#
+#   for name, (data, labels), error in ss.prefetch.iter_studies(ss.data.get_sleep_eeg_and_stages):
+#       ...
+#
+# n_prefetch studies load while the caller holds one, and with memory_limit,
+# at most that many bytes are in flight, counting the study the caller holds. A study is charged
+# estimate(name) bytes until its result is there, then the size of its arrays.
+# One study is always allowed, whatever its size.
+#
+# Errors do not stop the iteration: a failed study is yielded with result
+# None and the traceback as error.
+
+
+def edf_size(name):
+    return os.path.getsize(os.path.join(ss.data_dir, 'Sleep_Data', name + '.edf'))
+
+
+def nbytes(x):
+    # Size of the arrays in a result, tuples, lists and dicts included.
+    if isinstance(x, (np.ndarray, ss.epochs.Epochs)):
+        return x.nbytes
+    if isinstance(x, (tuple, list)):
+        return sum(nbytes(y) for y in x)
+    if isinstance(x, dict):
+        return sum(nbytes(y) for y in x.values())
+    return 0
+
+
+def _call(func, name, processes):
+    # Process workers send their profiling rows back with the result.
+    try:
+        with ss.profiling.study(name):
+            res = func(name), None
+    except Exception:
+        res = None, traceback.format_exc()
+
+    return res + (ss.profiling.collect() if processes and ss.profiling.enabled else [],)
+
+
+def iter_studies(func, studies=None, n_prefetch=2, memory_limit=None, ordered=True, processes=False,
+                 n_workers=None, estimate=edf_size):
+    # Yields (name, result, error) in the order of studies, or as results
+    # come in when ordered is False. Threads suit I/O and numpy/mne code that
+    # releases the GIL, with processes func and its results must pickle.
+    if studies is None:
+        studies = ss.data.study_list
+    studies = list(studies)
+
+    if n_workers is None:
+        n_workers = n_prefetch
+
+    if processes:
+        pool = ProcessPoolExecutor(n_workers, initializer=ss.preprocessing._init_worker,
+                                   initargs=(ss.data_dir, ss.cache_dir, ss.profiling.settings()))
+    else:
+        pool = ThreadPoolExecutor(n_workers)
+
+    pending = {} # future -> [name, bytes charged, whether that is the actual size]
+    order = deque()
+    in_flight = 0
+    i = 0
+
+    def fill():
+        # Charges finished studies their actual size and submits the next
+        # ones, as far as n_prefetch and memory_limit allow.
+        nonlocal in_flight, i
+
+        for future, x in pending.items():
+            if not x[2] and future.done():
+                size = nbytes(future.result()[0])
+                in_flight += size - x[1]
+                x[1:] = [size, True]
+
+        while i < len(studies) and len(pending) < n_prefetch:
+            size = estimate(studies[i]) if memory_limit is not None else 0
+            if memory_limit is not None and in_flight > 0 and in_flight + size > memory_limit:
+                break
+
+            future = pool.submit(_call, func, studies[i], processes)
+            pending[future] = [studies[i], size, False]
+            order.append(future)
+            in_flight += size
+            i += 1
+
+    try:
+        while i < len(studies) or len(pending) > 0:
+            fill()
+
+            if ordered:
+                future = order.popleft()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = next(x for x in order if x in done)
+                order.remove(future)
+
+            result, error, profile = future.result()
+            if len(profile) > 0:
+                ss.profiling.merge(profile)
+
+            name, size, actual = pending.pop(future)
+            if not actual:
+                size, in_flight = nbytes(result), in_flight - size + nbytes(result)
+
+            # The next studies load while the caller holds this one.
+            fill()
+
+            yield name, result, error
+
+            # Released by the caller only once it asks for the next study.
+            in_flight -= size
+
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
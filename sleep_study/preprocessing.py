@@ -0,0 +1,211 @@
+import os
+import json
+import hashlib
+import traceback
+import numpy as np
+from time import time
+from multiprocessing import Pool
+
+import sleep_study as ss
+
+# Each study is preprocessed into <out_dir>/<study>.npz. Every finished task
+# appends one line to <out_dir>/manifest.jsonl, recording whether the study
+# succeeded, failed or was skipped and under which parameters, so an
+# interrupted or re-configured run only redoes what is missing or stale.
+
+MANIFEST_FN = 'manifest.jsonl'
+
+
+class SkipStudy(Exception):
+    pass
+
+
+def get_epochs(name, channels):
+    missing = ss.montage.missing(ss.montage.get_plan(name, channels), channels)
+    if len(missing) > 0:
+        raise SkipStudy('missing channels: ' + ', '.join(missing))
+
+    return ss.data.get_sleep_eeg_and_stages(name, channels, cache=False)
+
+
+def get_compact_epochs(name, channels):
+    # int16 with the scaling of the EDF header, see ss.epochs.
+    data, labels = get_epochs(name, channels)
+    return ss.data.compact_epochs(name, channels, data), labels
+
+
+def params_key(channels, task):
+    params = {
+            'channels': list(channels),
+            'task': task.__module__ + '.' + task.__qualname__,
+            'reference_freq': ss.info.REFERENCE_FREQ,
+            'resample_method': ss.resample.DEFAULT_METHOD,
+            'interval': ss.info.INTERVAL,
+            }
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_manifest(out_dir):
+    path = os.path.join(os.path.expanduser(out_dir), MANIFEST_FN)
+    if not os.path.exists(path):
+        return {}
+
+    records = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be cut short by an interrupted run.
+                continue
+            records[record['study']] = record
+
+    return records
+
+
+def _init_worker(data_dir, cache_dir, profiling=None):
+    # Forked workers inherit an initialized package and this is a no-op,
+    # spawned ones set it up once here instead of once per task.
+    ss.init(data_dir, cache_dir)
+    ss.profiling.init_worker(profiling)
+
+
+def _run(args):
+    name, out_dir, channels, task, key = args
+
+    record = {'study': name, 'params': key, 'n_epochs': 0, 'error': None}
+    start = time()
+
+    try:
+        with ss.profiling.study(name):
+            data, labels = task(name, channels)
+
+        # Per-channel statistics are computed while the study is in memory,
+        # so normalizing never needs another pass over the data.
+        stats = ss.stats.ChannelStats.from_data(data)
+
+        # Compact epochs are stored as their digital values and scaling.
+        arrays = {'data': data}
+        if isinstance(data, ss.epochs.Epochs):
+            arrays = {'data': data.digital, 'gain': data.gain, 'offset': data.offset}
+
+        # Write under a temporary name first, so a crash never leaves a
+        # truncated file behind that looks finished.
+        path = os.path.join(out_dir, name + '.npz')
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, labels=labels, **arrays, **stats.arrays('stats_'))
+        os.replace(tmp_path, path)
+
+        record['status'] = 'success'
+        record['n_epochs'] = len(labels)
+
+    except SkipStudy as e:
+        record['status'] = 'skip'
+        record['error'] = str(e)
+
+    except Exception:
+        record['status'] = 'failure'
+        record['error'] = traceback.format_exc()
+
+    record['seconds'] = time() - start
+
+    # Sent back to the parent, which merges them and leaves them out of the manifest.
+    if ss.profiling.enabled:
+        record['profile'] = ss.profiling.collect()
+
+    return record
+
+
+def preprocess(studies=None, out_dir='~/preprocessed', channels=ss.info.EEG_CH_NAMES, task=get_epochs,
+               n_workers=None, chunksize=4, retry_failed=False, verbose=True):
+    out_dir = os.path.abspath(os.path.expanduser(out_dir))
+    os.makedirs(out_dir, exist_ok=True)
+
+    if studies is None:
+        studies = ss.data.study_list
+
+    key = params_key(channels, task)
+    manifest = load_manifest(out_dir)
+
+    # Resolved once here, forked workers inherit the plans.
+    plans = ss.montage.get_plans(channels)
+
+    done = ['success', 'skip'] if retry_failed else ['success', 'skip', 'failure']
+    todo = [name for name in studies
+            if name not in manifest
+            or manifest[name]['params'] != key
+            or manifest[name]['status'] not in done
+            or (manifest[name]['status'] == 'success'
+                and not os.path.exists(os.path.join(out_dir, name + '.npz')))
+            # Skipped for missing channels which now resolve, e.g. after
+            # aliases were added.
+            or (manifest[name]['status'] == 'skip'
+                and str(manifest[name]['error']).startswith('missing channels')
+                and None not in plans.get(name, [None]))]
+
+    # Largest studies first, so the pool does not end waiting on one big file.
+    def edf_size(name):
+        return os.path.getsize(os.path.join(ss.data_dir, 'Sleep_Data', name + '.edf'))
+    todo.sort(key=edf_size, reverse=True)
+
+    if verbose:
+        print('%d of %d studies to process' % (len(todo), len(studies)))
+
+    tasks = [(name, out_dir, list(channels), task, key) for name in todo]
+    counts = {'success': 0, 'skip': 0, 'failure': 0}
+
+    with open(os.path.join(out_dir, MANIFEST_FN), 'a') as f, \
+            Pool(n_workers, initializer=_init_worker,
+                 initargs=(ss.data_dir, ss.cache_dir, ss.profiling.settings())) as pool:
+
+        for i, record in enumerate(pool.imap_unordered(_run, tasks, chunksize=chunksize)):
+            if 'profile' in record:
+                ss.profiling.merge(record.pop('profile'))
+
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+
+            manifest[record['study']] = record
+            counts[record['status']] += 1
+
+            if verbose and record['status'] == 'failure':
+                print('Failed %s:\n%s' % (record['study'], record['error']))
+
+            if verbose and (i + 1) % 100 == 0:
+                print('Processed %d of %d' % (i + 1, len(todo)))
+
+    if verbose:
+        print('%d succeeded, %d skipped, %d failed' % (counts['success'], counts['skip'], counts['failure']))
+
+    return manifest
+
+
+def build_corpus(out_dir='~/preprocessed', path=None, channels=ss.info.EEG_CH_NAMES, dtype='float32',
+                 task=get_epochs):
+    # Only studies preprocessed with the same channels and task, others are
+    # left out of the corpus.
+    out_dir = os.path.abspath(os.path.expanduser(out_dir))
+    if path is None:
+        path = os.path.join(out_dir, 'corpus')
+
+    key = params_key(channels, task)
+    manifest = load_manifest(out_dir)
+    studies = sorted(name for name, record in manifest.items()
+                     if record['status'] == 'success' and record['params'] == key)
+
+    with ss.corpus.CorpusWriter(path, channels, ss.info.REFERENCE_FREQ, dtype) as writer:
+        for name in studies:
+            tmp = np.load(os.path.join(out_dir, name + '.npz'))
+
+            # Files of older runs have no statistics, the writer computes them.
+            stats = None
+            if 'stats_n' in tmp.files:
+                stats = ss.stats.ChannelStats.from_arrays(tmp, 'stats_')
+
+            data = tmp['data']
+            if 'gain' in tmp.files:
+                data = ss.epochs.Epochs(data, tmp['gain'], tmp['offset'])
+
+            writer.add(name, data, tmp['labels'], stats)
+
+    return ss.corpus.Corpus(path)
@@ -0,0 +1,232 @@
+import os
+import json
+import cProfile
+import resource
+import threading
+import pandas as pd
+from time import perf_counter
+from contextlib import contextmanager
+
+# Wall time, bytes, epochs, peak RSS and failures of the hot paths, per study
+# and stage. Off by default, timers then only cost a function call:
+#
+#   ss.profiling.enable()
+#   ss.preprocessing.preprocess(studies, n_workers=8)
+#   ss.profiling.stats.save('profile.csv')   # or .json
+#   ss.profiling.stats.summary()
+#
+# Stages are load_study, annotations (.tsv parsing), extract (decoding and
+# slicing epochs), resample, features and compress (dataset archives). Pool
+# workers of preprocessing and prefetch send their rows back with every
+# result, threads share the rows of their process. With profile_dir, every
+# study run under study() is also profiled with cProfile into
+# profile_dir/<study>.prof, e.g. for snakeviz or pstats.
+#
+# Peak RSS is the peak of the process so far when the stage ended, the
+# largest one seen for the row.
+
+FIELDS = ['calls', 'seconds', 'bytes', 'epochs', 'failures', 'max_rss_mb']
+
+enabled = False
+profile_dir = None
+stats = None # Rows of this process, created by enable().
+
+_local = threading.local()
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Counters:
+    # Filled in by the timed code, error marks a failure that was handled
+    # without raising.
+
+    def __init__(self):
+        self.bytes = 0
+        self.epochs = 0
+        self.error = None
+
+
+class Stats:
+
+    def __init__(self, rows=None):
+        self.rows = {} if rows is None else rows # (study, stage) -> FIELDS and the last error
+        self.lock = threading.Lock()
+
+    def add(self, study, stage, seconds, n_bytes=0, epochs=0, error=None):
+        rss = max_rss_mb()
+        with self.lock:
+            row = self.rows.get((study, stage))
+            if row is None:
+                row = self.rows[(study, stage)] = dict.fromkeys(FIELDS, 0)
+                row['error'] = None
+
+            row['calls'] += 1
+            row['seconds'] += seconds
+            row['bytes'] += n_bytes
+            row['epochs'] += epochs
+            row['max_rss_mb'] = max(row['max_rss_mb'], rss)
+            if error is not None:
+                row['failures'] += 1
+                row['error'] = error
+
+    def merge(self, other):
+        with self.lock:
+            for key, x in other.rows.items():
+                row = self.rows.get(key)
+                if row is None:
+                    self.rows[key] = dict(x)
+                    continue
+
+                for field in FIELDS[:-1]:
+                    row[field] += x[field]
+                row['max_rss_mb'] = max(row['max_rss_mb'], x['max_rss_mb'])
+                row['error'] = x['error'] or row['error']
+        return self
+
+    def to_list(self):
+        with self.lock:
+            return [dict(study=study, stage=stage, **row) for (study, stage), row in self.rows.items()]
+
+    @classmethod
+    def from_list(cls, rows):
+        return cls({(x['study'], x['stage']): {k: x[k] for k in FIELDS + ['error']} for x in rows})
+
+    def frame(self):
+        return pd.DataFrame(self.to_list(), columns=['study', 'stage'] + FIELDS + ['error'])
+
+    def summary(self):
+        # One row per stage, with throughput.
+        df = self.frame()
+        res = df.groupby('stage').agg({'study': 'nunique', 'calls': 'sum', 'seconds': 'sum', 'bytes': 'sum',
+                                       'epochs': 'sum', 'failures': 'sum', 'max_rss_mb': 'max'})
+        res = res.rename(columns={'study': 'studies'})
+        # NaN for stages which count no bytes or epochs, e.g. load_study
+        # without preload, whose samples are counted by extract.
+        seconds = res.seconds.where(res.seconds > 0)
+        res['mb_per_second'] = res.bytes.where(res.bytes > 0) / 1024**2 / seconds
+        res['epochs_per_second'] = res.epochs.where(res.epochs > 0) / seconds
+        return res
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        if path.endswith('.csv'):
+            self.frame().to_csv(tmp_path, index=False)
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.to_list(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith('.csv'):
+            df = pd.read_csv(path)
+            for column in ['study', 'error']:
+                df[column] = df[column].astype(object).where(df[column].notna(), None)
+            return cls.from_list(df.to_dict('records'))
+
+        with open(path) as f:
+            return cls.from_list(json.load(f))
+
+
+def enable(tmp_profile_dir=None):
+    global enabled, profile_dir, stats
+
+    enabled = True
+    profile_dir = tmp_profile_dir
+    if stats is None:
+        stats = Stats()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def settings():
+    # Passed to pool workers, see init_worker().
+    return enabled, profile_dir
+
+
+def init_worker(tmp_settings):
+    # Forked workers start from a copy of the parent's rows, which are
+    # dropped so they are not sent back twice.
+    global stats
+
+    stats = None
+    if tmp_settings is not None and tmp_settings[0]:
+        enable(tmp_settings[1])
+    else:
+        disable()
+
+
+def collect():
+    # Rows of this process since the last call, for pool workers.
+    global stats
+
+    if stats is None:
+        return []
+    rows, stats = stats.to_list(), Stats()
+    return rows
+
+
+def merge(rows):
+    global stats
+
+    if stats is None:
+        stats = Stats()
+    stats.merge(Stats.from_list(rows))
+
+
+def current_study():
+    return getattr(_local, 'study', None)
+
+
+@contextmanager
+def study(name):
+    # Stages run inside are counted for name, unless given one.
+    previous = current_study()
+    _local.study = name
+
+    profiler = None
+    if enabled and profile_dir is not None and previous is None:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active in this process.
+            profiler = None
+
+    try:
+        yield
+    finally:
+        _local.study = previous
+
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, name + '.prof'))
+
+
+@contextmanager
+def timer(stage, study=None):
+    # Yields Counters, the stage is recorded on exit, as a failure when it
+    # raised.
+    counters = Counters()
+    if not enabled:
+        yield counters
+        return
+
+    if study is None:
+        study = current_study()
+
+    start = perf_counter()
+    try:
+        yield counters
+    except Exception as e:
+        stats.add(study, stage, perf_counter() - start, counters.bytes, counters.epochs, repr(e))
+        raise
+
+    stats.add(study, stage, perf_counter() - start, counters.bytes, counters.epochs, counters.error)
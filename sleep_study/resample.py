@@ -0,0 +1,80 @@
+import numpy as np
+from math import gcd
+from functools import lru_cache
+
+import sleep_study as ss
+
+# 'poly' low-pass filters and resamples by a rational factor, e.g. 400 Hz to
+# 128 Hz is up 8, down 25. 'decimate' (integer ratios only) and 'linear' are
+# the original unfiltered methods, kept for comparison.
+METHODS = ['poly', 'decimate', 'linear']
+DEFAULT_METHOD = 'poly'
+
+
+@lru_cache(maxsize=None)
+def get_ratio(freq, new_freq):
+    g = gcd(int(freq), int(new_freq))
+    return int(new_freq) // g, int(freq) // g
+
+
+@lru_cache(maxsize=None)
+def get_filter(up, down):
+    # Same design as the default of signal.resample_poly, but only computed
+    # once per ratio instead of once per call.
+    from scipy import signal
+
+    max_rate = max(up, down)
+    h = signal.firwin(20 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+    h.setflags(write=False)
+    return h
+
+
+def get_output_length(n_samples, freq, new_freq):
+    up, down = get_ratio(freq, new_freq)
+    return -(-n_samples * up // down)
+
+
+def _resample(data, freq, new_freq, method):
+    from scipy import signal, interpolate
+
+    up, down = get_ratio(freq, new_freq)
+
+    if method == 'poly':
+        h = get_filter(up, down).astype(data.dtype)
+        # 'line' removes the linear trend of each epoch before filtering,
+        # which keeps the zero padding from ringing at the epoch edges.
+        return signal.resample_poly(data, up, down, axis=-1, window=h, padtype='line')
+
+    elif method == 'decimate':
+        assert up == 1, 'decimate only supports integer ratios'
+        return data[..., ::down]
+
+    elif method == 'linear':
+        duration = data.shape[-1] / freq
+        x = np.linspace(0, duration, num=data.shape[-1])
+        new_x = np.linspace(0, duration, num=get_output_length(data.shape[-1], freq, new_freq))
+        f = interpolate.interp1d(x, data, kind='linear', axis=-1, assume_sorted=True)
+        return f(new_x)
+
+    raise ValueError('unknown resampling method %s' % method)
+
+
+def resample_epochs(data, freq, new_freq=ss.info.REFERENCE_FREQ, method=DEFAULT_METHOD, chunk_size=256, out=None):
+    # data is (num epochs) by (num channels) by (num samples). Epochs are
+    # resampled chunk_size at a time into a preallocated output, so the
+    # temporaries of the filter stay bounded by the chunk.
+    if freq == new_freq:
+        return data
+
+    n_out = get_output_length(data.shape[-1], freq, new_freq)
+    if out is None:
+        out = np.empty(data.shape[:-1] + (n_out,), dtype=data.dtype)
+
+    with ss.profiling.timer('resample') as t:
+        for i in range(0, len(data), chunk_size):
+            out[i:i + chunk_size] = _resample(data[i:i + chunk_size], freq, new_freq, method)
+
+        t.bytes = data.nbytes
+        t.epochs = len(data)
+
+    return out
@@ -0,0 +1,146 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+import sleep_study as ss
+
+# Respiratory event and arousal indices of every study, from the annotation
+# store (see sleep_study.annotations). Descriptions are classified once per
+# unique description with one precompiled pattern, events are then counted
+# for all studies at once with np.bincount:
+#
+#   TST_HOURS      total sleep time, stages N1, N2, N3 and R
+#   N_<class>      number of events of every class in EVENT_CLASSES
+#   AHI            (apneas + hypopneas) per hour of sleep
+#   ODI            oxygen desaturations per hour of sleep
+#   AROUSAL_INDEX  arousals per hour of sleep
+#
+# By default every event counts, like in the README. With sleep_only, only
+# events starting within an epoch scored as sleep count.
+
+# Checked in order, the first matching class wins, e.g. 'Obstructive
+# Hypopnea' is a hypopnea and 'Central Apnea' is not counted as APNEA.
+EVENT_CLASSES = [
+        ('HYPOPNEA', r'hypop?nea'),
+        ('OBSTRUCTIVE_APNEA', r'obstructive.*apnea|apnea.*obstructive'),
+        ('CENTRAL_APNEA', r'central.*apnea|apnea.*central'),
+        ('MIXED_APNEA', r'mixed.*apnea|apnea.*mixed'),
+        ('APNEA', r'apnea'),
+        ('DESATURATION', r'desat'),
+        ('AROUSAL', r'arousal'),
+        ]
+
+APNEA_CLASSES = ['OBSTRUCTIVE_APNEA', 'CENTRAL_APNEA', 'MIXED_APNEA', 'APNEA']
+
+PATTERN = re.compile('|'.join('(?P<%s>.*(?:%s))' % x for x in EVENT_CLASSES), re.IGNORECASE | re.DOTALL)
+
+SLEEP_STAGES = ['Sleep stage N1', 'Sleep stage N2', 'Sleep stage N3', 'Sleep stage R']
+
+
+def classify(descriptions):
+    # Class index of every description into EVENT_CLASSES, len(EVENT_CLASSES)
+    # for descriptions of no class.
+    names = [x for x, _ in EVENT_CLASSES]
+    res = np.full(len(descriptions), len(names), dtype=np.int64)
+    for i, x in enumerate(descriptions):
+        m = PATTERN.match(x)
+        if m is not None:
+            res[i] = names.index(m.lastgroup)
+    return res
+
+
+def _sleep_mask(s, is_event):
+    # Whether every event starts within a sleep epoch of its study. Epochs
+    # and events of all studies are matched with one searchsorted on
+    # (study, onset) keys.
+    stage = np.zeros(len(s.descriptions) + 1, dtype=np.int8)
+    stage[s.description_codes(list(ss.info.EVENT_DICT))] = 1
+    stage[s.description_codes(SLEEP_STAGES)] = 2
+    stage = stage[s.description]
+
+    low = s.onset.min(initial=0)
+    span = s.onset.max(initial=0) - low + 2 * ss.info.INTERVAL
+    key = s.study * span + (s.onset - low)
+
+    epochs = np.flatnonzero(stage > 0)
+    epochs = epochs[np.argsort(key[epochs], kind='stable')]
+
+    events = np.flatnonzero(is_event)
+    i = np.searchsorted(key[epochs], key[events], side='right') - 1
+
+    valid = i >= 0
+    j = epochs[np.maximum(i, 0)]
+    valid &= s.study[j] == s.study[events]
+    valid &= s.onset[events] < s.onset[j] + ss.info.INTERVAL
+    valid &= stage[j] == 2
+
+    mask = np.zeros(len(s.study), dtype=bool)
+    mask[events[valid]] = True
+    return mask
+
+
+def compute_indices(sleep_only=False):
+    s = ss.annotations.get_store()
+    names = [x for x, _ in EVENT_CLASSES]
+    k = len(names)
+
+    cls = classify(s.descriptions)[s.description] if len(s.descriptions) > 0 else np.empty(0, dtype=np.int64)
+    if sleep_only:
+        cls = np.where(_sleep_mask(s, cls < k), cls, k)
+
+    counts = np.bincount(s.study * (k + 1) + cls, minlength=len(s.studies) * (k + 1))
+    counts = counts.reshape(len(s.studies), k + 1)[:, :k]
+
+    df = pd.DataFrame(counts, index=s.studies, columns=['N_' + x for x in names])
+    df.insert(0, 'TST_HOURS', ss.annotations.stage_counts()[SLEEP_STAGES].sum(axis=1) * ss.info.INTERVAL / 3600)
+
+    hours = df.TST_HOURS.where(df.TST_HOURS > 0)
+    df['AHI'] = (df[['N_' + x for x in APNEA_CLASSES]].sum(axis=1) + df.N_HYPOPNEA) / hours
+    df['ODI'] = df.N_DESATURATION / hours
+    df['AROUSAL_INDEX'] = df.N_AROUSAL / hours
+
+    df.index.name = 'STUDY'
+    return df
+
+
+def _cache_path(sleep_only):
+    if ss.cache_dir is None:
+        return None
+    return os.path.join(ss.cache_dir, 'respiratory', 'indices.%d' % sleep_only)
+
+
+def get_indices(studies=None, sleep_only=False, refresh=False, n_workers=1):
+    # With a cache directory, the table is stored as a pickled frame next to
+    # a hash of the mtime/size of every .tsv and of EVENT_CLASSES, and only
+    # computed again when one of them changed. n_workers parse changed .tsv
+    # files in parallel when the annotation store is refreshed.
+    s = ss.annotations.get_store(refresh=refresh, n_workers=n_workers)
+    path = _cache_path(sleep_only)
+
+    df = None
+    if path is not None:
+        stamp = hashlib.sha1(json.dumps([s.stamps, EVENT_CLASSES], sort_keys=True).encode()).hexdigest()
+
+        try:
+            with open(path + '.stamp') as f:
+                if f.read() == stamp and not refresh:
+                    df = pd.read_pickle(path + '.pkl')
+        except OSError:
+            pass
+
+    if df is None:
+        df = compute_indices(sleep_only)
+
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_pickle(path + '.pkl.tmp')
+            os.replace(path + '.pkl.tmp', path + '.pkl')
+            with open(path + '.stamp', 'w') as f:
+                f.write(stamp)
+
+    if studies is not None:
+        df = df.loc[list(studies)]
+    return df
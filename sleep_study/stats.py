@@ -0,0 +1,191 @@
+import numpy as np
+
+# Per-channel statistics of signals, computed in one streaming pass and
+# mergeable across batches, studies and workers:
+#
+#   n, mean, m2   count, mean and sum of squared deviations (Welford / Chan)
+#   min, max
+#   hist          counts over fixed bins, for approximate percentiles
+#
+# Every array has the channel as its last axis (before the bins of hist), and
+# may have leading axes, e.g. one row per study in a corpus.
+#
+# The bins are uniform in arcsinh(x / HIST_SCALE), i.e. linear around zero and
+# logarithmic beyond, so a fixed number of them covers microvolt EEG as well
+# as artifacts volts large with about 2% relative resolution.
+
+HIST_BINS = 2048
+HIST_SCALE = 1e-6
+HIST_LIMIT = 16. # arcsinh(x / HIST_SCALE) range, i.e. +-4.4e6 * HIST_SCALE
+
+FIELDS = ['n', 'mean', 'm2', 'min', 'max', 'hist']
+
+
+def hist_index(x):
+    t = np.arcsinh(np.asarray(x, dtype=np.float32) / np.float32(HIST_SCALE))
+    t = (t + HIST_LIMIT) * (HIST_BINS / (2 * HIST_LIMIT))
+    return np.clip(t, 0, HIST_BINS - 1).astype(np.intp)
+
+
+def hist_edges():
+    t = np.linspace(-HIST_LIMIT, HIST_LIMIT, HIST_BINS + 1)
+    return np.sinh(t) * HIST_SCALE
+
+
+class ChannelStats:
+
+    def __init__(self, n, mean, m2, min, max, hist):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+        self.hist = hist
+
+    @classmethod
+    def empty(cls, shape):
+        # shape is the shape without the bins, e.g. (num channels,).
+        shape = tuple(np.atleast_1d(shape))
+        return cls(np.zeros(shape, dtype=np.int64),
+                   np.zeros(shape),
+                   np.zeros(shape),
+                   np.full(shape, np.inf),
+                   np.full(shape, -np.inf),
+                   np.zeros(shape + (HIST_BINS,), dtype=np.int64))
+
+    @classmethod
+    def from_data(cls, data, chunk_size=256):
+        # data is (num epochs) by (num channels) by (num samples), or any
+        # array with channels on its second to last axis.
+        data = np.asarray(data)
+        n_channels = data.shape[-2]
+        data = data.reshape((-1,) + data.shape[-2:])
+
+        stats = cls.empty(n_channels)
+        offsets = np.arange(n_channels)[:, np.newaxis] * HIST_BINS
+
+        # Exact two-pass moments within a chunk, merged across chunks, so the
+        # temporaries stay bounded by the chunk.
+        for i in range(0, len(data), chunk_size):
+            x = data[i:i + chunk_size]
+            n = x.shape[0] * x.shape[2]
+
+            # Integer data would overflow in the squares.
+            if not np.issubdtype(x.dtype, np.floating):
+                x = x.astype(np.float64)
+            if n == 0:
+                continue
+
+            mean = x.mean(axis=(0, 2), dtype=np.float64)
+            m2 = np.square(x - mean[:, np.newaxis].astype(x.dtype)).sum(axis=(0, 2), dtype=np.float64)
+
+            idx = hist_index(x) + offsets
+            hist = np.bincount(idx.ravel(), minlength=n_channels * HIST_BINS).reshape(n_channels, HIST_BINS)
+
+            stats.merge(cls(np.full(n_channels, n, dtype=np.int64), mean, m2,
+                            x.min(axis=(0, 2)).astype(np.float64), x.max(axis=(0, 2)).astype(np.float64), hist))
+
+        return stats
+
+    def update(self, data):
+        return self.merge(ChannelStats.from_data(data))
+
+    def merge(self, other):
+        # Chan et al. pairwise update, in place.
+        n = self.n + other.n
+        w = np.divide(other.n, n, out=np.zeros(n.shape), where=n > 0)
+        delta = other.mean - self.mean
+
+        self.m2 = self.m2 + other.m2 + delta**2 * self.n * w
+        self.mean = self.mean + delta * w
+        self.n = n
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.hist = self.hist + other.hist
+        return self
+
+    def reduce(self, axis=0):
+        # Merges the rows along a leading axis at once, e.g. all studies of a
+        # corpus into corpus-level statistics.
+        n = self.n.sum(axis=axis)
+        mean = np.divide((self.n * self.mean).sum(axis=axis), n, out=np.zeros(n.shape), where=n > 0)
+        m2 = (self.m2 + self.n * (self.mean - np.expand_dims(mean, axis))**2).sum(axis=axis)
+
+        return ChannelStats(n, mean, m2, self.min.min(axis=axis), self.max.max(axis=axis), self.hist.sum(axis=axis))
+
+    @classmethod
+    def stack(cls, stats):
+        return cls(*[np.stack([getattr(x, k) for x in stats]) for k in FIELDS])
+
+    def __getitem__(self, idx):
+        return ChannelStats(*[getattr(self, k)[idx] for k in FIELDS])
+
+    @property
+    def var(self):
+        return np.divide(self.m2, self.n, out=np.full(self.n.shape, np.nan), where=self.n > 0)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def percentile(self, q):
+        # Interpolated within the bin containing the q-th percentile, so
+        # accurate to the bin width. Returns (len(q)) by (shape) for a list q.
+        scalar = np.ndim(q) == 0
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+
+        cum = np.cumsum(self.hist, axis=-1)
+        target = q.reshape((-1,) + (1,) * self.n.ndim) / 100 * self.n
+
+        # First bin whose cumulative count reaches the target.
+        i = (cum[np.newaxis] < target[..., np.newaxis]).sum(axis=-1)
+        i = np.minimum(i, HIST_BINS - 1)
+
+        before = np.take_along_axis(np.broadcast_to(cum, i.shape + (HIST_BINS,)), np.maximum(i - 1, 0)[..., np.newaxis], -1)[..., 0]
+        before = np.where(i > 0, before, 0)
+        count = np.take_along_axis(np.broadcast_to(self.hist, i.shape + (HIST_BINS,)), i[..., np.newaxis], -1)[..., 0]
+        frac = np.clip(np.divide(target - before, count, out=np.zeros(i.shape), where=count > 0), 0, 1)
+
+        width = 2 * HIST_LIMIT / HIST_BINS
+        value = np.sinh(-HIST_LIMIT + (i + frac) * width) * HIST_SCALE
+        value = np.clip(value, self.min, self.max)
+        value = np.where(self.n > 0, value, np.nan)
+
+        return value[0] if scalar else value
+
+    @property
+    def median(self):
+        return self.percentile(50)
+
+    @property
+    def iqr(self):
+        low, high = self.percentile([25, 75])
+        return high - low
+
+    def scaling(self, robust=False):
+        # Center and scale to normalize with, mean and std, or with robust
+        # median and IQR (scaled to match std for normal data). Channels
+        # without variation get a scale of 1.
+        if robust:
+            loc, scale = self.median, self.iqr / 1.349
+        else:
+            loc, scale = self.mean, self.std
+
+        loc = np.nan_to_num(loc)
+        scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.)
+        return loc, scale
+
+    def arrays(self, prefix=''):
+        return {prefix + k: getattr(self, k) for k in FIELDS}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        return cls(*[np.asarray(arrays[prefix + k]) for k in FIELDS])
+
+    def save(self, path):
+        np.savez(path, **self.arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls.from_arrays(f)
@@ -0,0 +1,385 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler, DataLoader
+
+import sleep_study as ss
+
+# PyTorch access to a corpus (see sleep_study.corpus) at the level of single
+# epochs or fixed-length sequences of consecutive epochs of one study. Not
+# imported by sleep_study itself, since torch is optional:
+#
+#   import sleep_study.torch_data as td
+#   dataset = td.EpochDataset('~/preprocessed/corpus', seq_len=20)
+#   loader = td.make_loader(dataset, 64, td.StudyGroupedSampler(dataset))
+#
+# or of whole nights, which differ in length, bucketed into padded batches:
+#
+#   dataset = td.NightDataset('~/preprocessed/corpus', max_len=1200)
+#   loader = td.make_loader(dataset, batch_sampler=td.BucketBatchSampler(dataset.lengths, 8),
+#                           collate_fn=td.pad_collate)
+
+# Label of padded epochs, ignored by nn.NLLLoss and nn.CrossEntropyLoss.
+PAD_LABEL = -100
+
+
+def get_scaling(corpus, normalize, robust=False):
+    # (num studies) by (num channels) center and scale from the statistics
+    # stored with the corpus: of each study with 'study', of the whole corpus
+    # with 'corpus'.
+    stats = corpus.get_stats()
+
+    if normalize == 'corpus':
+        stats = stats.reduce()
+    elif normalize != 'study':
+        raise ValueError('unknown normalization %s' % normalize)
+
+    loc, scale = stats.scaling(robust)
+    shape = (len(corpus.studies), len(corpus.channels))
+    return np.broadcast_to(loc, shape).astype(np.float32), np.broadcast_to(scale, shape).astype(np.float32)
+
+
+def get_affine(corpus, scaling=None):
+    # (num studies) by (num channels) gain and offset turning the digital
+    # values of an int16 corpus into physical ones, or with scaling (see
+    # get_scaling) directly into standardized ones, in one multiply-add.
+    gain, offset = corpus.gain, corpus.offset
+    if scaling is not None:
+        loc, scale = scaling
+        gain, offset = gain / scale, (offset - loc) / scale
+    return gain.astype(np.float32), offset.astype(np.float32)
+
+
+class EpochDataset(Dataset):
+
+    def __init__(self, corpus, seq_len=1, stride=None, studies=None, transform=None,
+                 normalize=None, robust=False):
+        # Sample i is seq_len consecutive epochs of one study, windows start
+        # every stride epochs (seq_len by default, i.e. not overlapping).
+        # normalize ('study' or 'corpus', see get_scaling) standardizes every
+        # channel on the fly, with robust by median and IQR.
+        if not isinstance(corpus, ss.corpus.Corpus):
+            corpus = ss.corpus.Corpus(corpus)
+
+        self.corpus = corpus
+        self.seq_len = seq_len
+        self.stride = seq_len if stride is None else stride
+        self.transform = transform
+
+        self.scaling = None
+        if normalize is not None:
+            self.scaling = get_scaling(corpus, normalize, robust)
+
+        # Of int16 corpora, converted to float32 per batch.
+        self.affine = None
+        if corpus.gain is not None:
+            self.affine = get_affine(corpus, self.scaling)
+
+        if studies is None:
+            studies = corpus.studies
+
+        starts = []
+        study_ids = []
+        for name in studies:
+            i = corpus.study_ids[name]
+            s = np.arange(corpus.offsets[i], corpus.offsets[i + 1] - seq_len + 1, self.stride)
+            starts.append(s)
+            study_ids.append(np.full(len(s), i))
+
+        self.starts = np.concatenate(starts + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+        self.study_ids = np.concatenate(study_ids + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+
+        # Window steps within a sequence, added to the start of each sample.
+        self.steps = np.arange(seq_len)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def labels(self):
+        # Label of the last epoch of every sample, e.g. for balanced sampling.
+        return np.asarray(self.corpus.labels[self.starts + self.seq_len - 1])
+
+    def __getitem__(self, idx):
+        data, labels = self.__getitems__([idx])
+        return data[0], labels[0]
+
+    def __getitems__(self, indices):
+        # Called by DataLoader with the whole batch of indices, which are read
+        # from the memory-mapped corpus with one fancy index instead of one
+        # read per sample. Returns stacked (data, labels) arrays.
+        idx = (self.starts[np.asarray(indices)][:, np.newaxis] + self.steps).ravel()
+
+        data = self.corpus.data[idx].reshape((len(indices), self.seq_len) + self.corpus.data.shape[1:])
+        labels = np.asarray(self.corpus.labels[idx]).reshape(len(indices), self.seq_len)
+
+        if self.affine is not None:
+            study_ids = self.study_ids[np.asarray(indices)]
+            gain, offset = self.affine
+            data = data.astype(np.float32)
+            data *= gain[study_ids][:, np.newaxis, :, np.newaxis]
+            data += offset[study_ids][:, np.newaxis, :, np.newaxis]
+
+        elif self.scaling is not None:
+            # The fancy index above copied the data, it is scaled in place.
+            data = np.asarray(data, dtype=np.float32)
+            study_ids = self.study_ids[np.asarray(indices)]
+            loc, scale = self.scaling
+            data -= loc[study_ids][:, np.newaxis, :, np.newaxis]
+            data /= scale[study_ids][:, np.newaxis, :, np.newaxis]
+
+        if self.seq_len == 1:
+            data, labels = data[:, 0], labels[:, 0]
+
+        if self.transform is not None:
+            data = self.transform(data)
+
+        return data, labels
+
+
+def collate_epochs(batch):
+    # batch is the stacked (data, labels) pair from EpochDataset.__getitems__,
+    # or a list of single samples. Produces contiguous float32 data and int64 labels,
+    # which DataLoader(pin_memory=True) copies into pinned memory.
+    if isinstance(batch, tuple):
+        data, labels = batch
+    else:
+        data = np.stack([x[0] for x in batch])
+        labels = np.stack([x[1] for x in batch])
+
+    data = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))
+    labels = torch.from_numpy(np.ascontiguousarray(labels, dtype=np.int64))
+    return data, labels
+
+
+class NightDataset(Dataset):
+
+    def __init__(self, corpus, max_len=None, studies=None, transform=None, normalize=None, robust=False):
+        # Sample i is a whole night, or with max_len a piece of at most
+        # max_len consecutive epochs of one, nights being cut into pieces of
+        # (almost) equal length. normalize and robust as in EpochDataset.
+        if not isinstance(corpus, ss.corpus.Corpus):
+            corpus = ss.corpus.Corpus(corpus)
+
+        self.corpus = corpus
+        self.transform = transform
+
+        self.scaling = None
+        if normalize is not None:
+            self.scaling = get_scaling(corpus, normalize, robust)
+
+        self.affine = None
+        if corpus.gain is not None:
+            self.affine = get_affine(corpus, self.scaling)
+
+        if studies is None:
+            studies = corpus.studies
+
+        bounds = []
+        study_ids = []
+        for name in studies:
+            i = corpus.study_ids[name]
+            start, stop = corpus.offsets[i], corpus.offsets[i + 1]
+            n = 1 if max_len is None else max(-(-(stop - start) // max_len), 1)
+            b = np.linspace(start, stop, n + 1).round().astype(np.int64)
+            bounds += list(zip(b[:-1], b[1:]))
+            study_ids += [i] * n
+
+        self.bounds = np.array(bounds, dtype=np.int64).reshape(-1, 2)
+        self.study_ids = np.array(study_ids, dtype=np.int64)
+        self.lengths = self.bounds[:, 1] - self.bounds[:, 0]
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __getitem__(self, idx):
+        # Views into the memory-mapped corpus, copied once by pad_collate.
+        start, stop = self.bounds[idx]
+        data, labels = self.corpus.data[start:stop], self.corpus.labels[start:stop]
+
+        if self.affine is not None:
+            gain, offset = self.affine
+            i = self.study_ids[idx]
+            data = data * gain[i][:, np.newaxis] + offset[i][:, np.newaxis]
+
+        elif self.scaling is not None:
+            loc, scale = self.scaling
+            i = self.study_ids[idx]
+            data = (data - loc[i][:, np.newaxis]) / scale[i][:, np.newaxis]
+
+        if self.transform is not None:
+            data = self.transform(data)
+
+        return data, labels
+
+
+def pad_collate(batch):
+    # batch is a list of (data, labels) of different lengths. Returns
+    #   data     (batch) by (max length) by (num channels) by (num samples), float32
+    #   labels   (batch) by (max length), int64, PAD_LABEL after the end
+    #   lengths  (batch), int64, e.g. for nn.utils.rnn.pack_padded_sequence
+    # The mask of real epochs is labels != PAD_LABEL.
+    lengths = np.array([len(x[1]) for x in batch], dtype=np.int64)
+    n = lengths.max(initial=0)
+
+    data = np.zeros((len(batch), n) + batch[0][0].shape[1:], dtype=np.float32)
+    labels = np.full((len(batch), n), PAD_LABEL, dtype=np.int64)
+
+    for i, (x, y) in enumerate(batch):
+        data[i, :len(y)] = x
+        labels[i, :len(y)] = y
+
+    return torch.from_numpy(data), torch.from_numpy(labels), torch.from_numpy(lengths)
+
+
+def _split(indices, num_replicas, rank):
+    # Equal contiguous parts for every replica, padded by wrapping around so
+    # that all ranks run the same number of batches.
+    n = -(-len(indices) // num_replicas)
+    if len(indices) > 0 and n * num_replicas > len(indices):
+        indices = np.resize(indices, n * num_replicas)
+    return indices[rank * n:(rank + 1) * n]
+
+
+class StudyGroupedSampler(Sampler):
+    # Shuffles the order of studies and the order of samples within each
+    # study, then yields study by study, so consecutive reads stay within the
+    # same region of the corpus. Splits the result between DDP replicas.
+
+    def __init__(self, dataset, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        # Samples of a study are contiguous in the dataset.
+        ids = dataset.study_ids
+        self.bounds = np.flatnonzero(np.diff(ids, prepend=-1, append=-1) != 0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _indices(self):
+        groups = [np.arange(a, b) for a, b in zip(self.bounds[:-1], self.bounds[1:])]
+
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            for g in groups:
+                rng.shuffle(g)
+            groups = [groups[i] for i in rng.permutation(len(groups))]
+
+        indices = np.concatenate(groups + [np.empty(0, dtype=np.int64)])
+        return _split(indices, self.num_replicas, self.rank)
+
+    def __iter__(self):
+        return iter(self._indices().tolist())
+
+    def __len__(self):
+        return -(-len(self.dataset) // self.num_replicas)
+
+
+class StageBalancedSampler(Sampler):
+    # Draws num_samples samples with replacement so that every sleep stage is
+    # equally likely. Each block of block_size draws is sorted, which keeps
+    # reads local without changing which samples are drawn.
+
+    def __init__(self, dataset, num_samples=None, block_size=4096, seed=0, num_replicas=1, rank=0):
+        self.dataset = dataset
+        self.num_samples = len(dataset) if num_samples is None else num_samples
+        self.block_size = block_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        labels = dataset.labels()
+        counts = np.bincount(labels, minlength=len(ss.info.EVENT_DICT))
+        weights = 1. / np.maximum(counts, 1)
+        self.p = weights[labels] / weights[labels].sum()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _indices(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.choice(len(self.p), self.num_samples, p=self.p)
+
+        for i in range(0, len(indices), self.block_size):
+            indices[i:i + self.block_size].sort()
+
+        return _split(indices, self.num_replicas, self.rank)
+
+    def __iter__(self):
+        return iter(self._indices().tolist())
+
+    def __len__(self):
+        return -(-self.num_samples // self.num_replicas)
+
+
+class BucketBatchSampler(Sampler):
+    # Yields batches of indices of samples with similar lengths, so padding
+    # them to the longest one wastes little. Samples are shuffled, cut into
+    # pools of bucket_size batches, each pool sorted by length and cut into
+    # batches, and the batches are shuffled again. Without shuffle, batches
+    # simply follow the samples sorted by length. Splits the batches between
+    # DDP replicas.
+
+    def __init__(self, lengths, batch_size, bucket_size=32, shuffle=True, drop_last=False,
+                 seed=0, num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+
+        if self.shuffle:
+            indices = rng.permutation(len(self.lengths))
+            pool = self.batch_size * self.bucket_size
+        else:
+            indices = np.arange(len(self.lengths))
+            pool = max(len(indices), 1)
+
+        batches = []
+        for i in range(0, len(indices), pool):
+            chunk = indices[i:i + pool]
+            chunk = chunk[np.argsort(-self.lengths[chunk], kind='stable')]
+            batches += [chunk[j:j + self.batch_size] for j in range(0, len(chunk), self.batch_size)]
+
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        return [batches[i] for i in _split(np.arange(len(batches)), self.num_replicas, self.rank)]
+
+    def __iter__(self):
+        return iter([b.tolist() for b in self._batches()])
+
+    def __len__(self):
+        return len(self._batches())
+
+
+def make_loader(dataset, batch_size=1, sampler=None, num_workers=4, pin_memory=True,
+                batch_sampler=None, collate_fn=collate_epochs, **kwargs):
+    # Workers stay alive between epochs and keep two batches each in flight.
+    if num_workers > 0:
+        kwargs.setdefault('persistent_workers', True)
+        kwargs.setdefault('prefetch_factor', 2)
+
+    if batch_sampler is not None:
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                          num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn,
+                      num_workers=num_workers, pin_memory=pin_memory, **kwargs)
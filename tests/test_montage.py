@@ -0,0 +1,13 @@
+import sleep_study as ss
+
+
+def test_get_plan_uses_cached_plans(monkeypatch):
+    channels = ['EEG C3-M2']
+    plan = [[('EEG C3-M2', 1.)]]
+    monkeypatch.setattr(ss.montage, 'plans', {ss.montage.plans_key(channels): {'1_1': plan}})
+
+    def resolve_all(*args):
+        raise AssertionError('plan of a cached study resolved again')
+    monkeypatch.setattr(ss.montage, 'resolve_all', resolve_all)
+
+    assert ss.montage.get_plan('1_1', channels) == plan